@@ -0,0 +1,113 @@
+"""
+Checks the fused CEM concept heads against the per-concept generators they replaced, and compares their latency.
+
+1. Round trip: the state dict of a ConceptEmbeddingModel built with the legacy per-concept
+   `concept_context_generators` / `concept_prob_generators` is loaded into the fused model (through
+   `convert_legacy_concept_heads`), whose contexts and concept probabilities must match the legacy modules.
+2. Latency of a forward + backward pass of the legacy loop and of the fused heads, across n_concepts.
+
+Run from the repository root: python -m benchmarks.cem_concept_heads
+"""
+import argparse
+import torch
+from torchvision.models import resnet18
+
+from benchmarks.common import measure_step
+from models.cem import ConceptEmbeddingModel, ConceptHeads, _EMBEDDING_ACTIVATIONS
+
+
+class LegacyConceptHeads(torch.nn.Module):
+    """The per-concept generators of ConceptEmbeddingModel before they were fused, with the same state dict keys."""
+
+    def __init__(self, in_features, n_concepts, emb_size, embedding_activation="leakyrelu", shared_prob_gen=True):
+        super().__init__()
+        self.concept_context_generators = torch.nn.ModuleList()
+        self.concept_prob_generators = torch.nn.ModuleList()
+        self.shared_prob_gen = shared_prob_gen
+        for _ in range(n_concepts):
+            layers = [torch.nn.Linear(in_features, 2 * emb_size)]
+            if embedding_activation is not None:
+                layers.append(_EMBEDDING_ACTIVATIONS[embedding_activation]())
+            self.concept_context_generators.append(torch.nn.Sequential(*layers))
+            if not shared_prob_gen or len(self.concept_prob_generators) == 0:
+                self.concept_prob_generators.append(torch.nn.Linear(2 * emb_size, 1))
+
+    def forward(self, pre_c):
+        contexts = []
+        c_sem = []
+        for i, context_gen in enumerate(self.concept_context_generators):
+            prob_gen = self.concept_prob_generators[0 if self.shared_prob_gen else i]
+            context = context_gen(pre_c)
+            contexts.append(torch.unsqueeze(context, dim=1))
+            c_sem.append(torch.sigmoid(prob_gen(context)))
+        return torch.cat(contexts, axis=1), torch.cat(c_sem, axis=-1)
+
+
+def check_round_trip(n_concepts, emb_size, embedding_activation, shared_prob_gen, atol=1e-5):
+    model = ConceptEmbeddingModel(
+        n_concepts,
+        n_tasks=5,
+        emb_size=emb_size,
+        embedding_activation=embedding_activation,
+        shared_prob_gen=shared_prob_gen,
+        c_extractor_arch=lambda output_dim: resnet18(),
+        training_intervention_prob=0,
+    ).eval()
+    legacy = LegacyConceptHeads(
+        model.concept_heads.in_features,
+        n_concepts,
+        emb_size,
+        embedding_activation=embedding_activation,
+        shared_prob_gen=shared_prob_gen,
+    )
+    # A checkpoint saved before the heads were fused
+    state_dict = {key: value for key, value in model.state_dict().items() if not key.startswith('concept_heads.')}
+    state_dict.update(legacy.state_dict())
+    model.load_state_dict(state_dict, strict=True)
+
+    x = torch.rand(4, 3, 224, 224)
+    with torch.no_grad():
+        pre_c = model.pre_concept_model(x)
+        contexts, c_sem = model.concept_heads(pre_c)
+        legacy_contexts, legacy_c_sem = legacy(pre_c)
+        model_c_sem = model._forward(x)[0]
+    assert torch.allclose(contexts, legacy_contexts, atol=atol), "contexts differ from the legacy generators"
+    assert torch.allclose(c_sem, legacy_c_sem, atol=atol), "concept probabilities differ from the legacy generators"
+    assert torch.allclose(model_c_sem, legacy_c_sem, atol=atol), "model outputs differ from the legacy generators"
+    print(f"round trip OK: activation={embedding_activation}, shared_prob_gen={shared_prob_gen}, "
+          f"max |diff| {(c_sem - legacy_c_sem).abs().max().item():.2e}")
+
+
+def compare_latency(n_concepts, in_features, emb_size, batch_size, device, repeats):
+    pre_c = torch.rand(batch_size, in_features, device=device, requires_grad=True)
+    heads = {
+        'legacy': LegacyConceptHeads(in_features, n_concepts, emb_size, shared_prob_gen=False).to(device),
+        'fused': ConceptHeads(in_features, n_concepts, emb_size, shared_prob_gen=False).to(device),
+    }
+    for name, module in heads.items():
+        def step():
+            contexts, c_sem = module(pre_c)
+            (contexts.sum() + c_sem.sum()).backward()
+
+        step_time, memory = measure_step(step, device, repeats=repeats)
+        print(f"n_concepts={n_concepts:4d} {name:>6}: {step_time:8.2f} ms/step, {memory:8.2f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Fused CEM concept heads: legacy round trip and latency")
+    parser.add_argument('--n_concepts', type=int, nargs='+', default=[10, 112, 312])
+    parser.add_argument('--in_features', type=int, default=1000)
+    parser.add_argument('--emb_size', type=int, default=16)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for embedding_activation in _EMBEDDING_ACTIVATIONS:
+        for shared_prob_gen in (True, False):
+            check_round_trip(12, args.emb_size, embedding_activation, shared_prob_gen)
+    for n_concepts in args.n_concepts:
+        compare_latency(
+            n_concepts, args.in_features, args.emb_size, args.batch_size, torch.device(args.device), args.repeats
+        )
@@ -0,0 +1,81 @@
+"""
+Checks the pooled fast path of the CEM unlabeled branch against the heatmap it replaced, and compares their cost.
+
+c_pred_unlabeled used to be sigmoid(AdaptiveAvgPool(heatmap)), with the [B, n_concepts, W, H] heatmap built from
+the trunk feature map; `ConceptEmbeddingModel._pooled_unlabeled` pools the feature map first instead.
+
+1. Equivalence, in float64: `_forward` with and without `output_heatmap`, and `_pooled_unlabeled` against
+   `concept_heatmap` followed by global average pooling, must agree within `--atol`.
+2. Time and memory of a forward + backward pass of the unlabeled branch through both paths.
+
+Run from the repository root: python -m benchmarks.cem_unlabeled_branch
+"""
+import argparse
+import torch
+from torchvision.models import resnet18
+
+from benchmarks.common import measure_step
+from models.cem import ConceptEmbeddingModel
+
+
+def heatmap_unlabeled(model, feature_map, c_embedding):
+    return model.sigmoid(torch.flatten(model.pooling(model.concept_heatmap(feature_map, c_embedding)), 1))
+
+
+def check_equivalence(model, n_concepts, emb_size, atol):
+    model = model.double()
+    with torch.no_grad():
+        x = torch.rand(4, 3, 224, 224, dtype=torch.float64)
+        pooled = model._forward(x)[2]
+        from_heatmap = model._forward(x, output_heatmap=True)[2]
+        diff = (pooled - from_heatmap).abs().max().item()
+        assert diff <= atol, f"_forward: pooled path differs from the heatmap path by {diff}"
+        print(f"_forward equivalence OK: max |diff| {diff:.2e}")
+
+        feature_map = torch.randn(8, model.trunk.feature_dim, 10, 10, dtype=torch.float64)
+        c_embedding = torch.randn(8, n_concepts, emb_size, dtype=torch.float64)
+        diff = (
+                model._pooled_unlabeled(feature_map, c_embedding) - heatmap_unlabeled(model, feature_map, c_embedding)
+        ).abs().max().item()
+        assert diff <= atol, f"_pooled_unlabeled differs from concept_heatmap + pooling by {diff}"
+        print(f"_pooled_unlabeled equivalence OK: max |diff| {diff:.2e}")
+    model.float()
+
+
+def compare_cost(model, n_concepts, emb_size, batch_size, spatial, device, repeats):
+    model = model.to(device)
+    feature_map = torch.rand(batch_size, model.trunk.feature_dim, spatial, spatial, device=device, requires_grad=True)
+    c_embedding = torch.rand(batch_size, n_concepts, emb_size, device=device, requires_grad=True)
+    paths = {
+        'heatmap': lambda: heatmap_unlabeled(model, feature_map, c_embedding),
+        'pooled': lambda: model._pooled_unlabeled(feature_map, c_embedding),
+    }
+    for name, path in paths.items():
+        step_time, memory = measure_step(lambda: path().sum().backward(), device, repeats=repeats)
+        print(f"{name:>7}: {step_time:8.2f} ms/step, {batch_size / step_time * 1000:8.0f} images/s, "
+              f"{memory:8.2f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="CEM unlabeled branch: pooled fast path vs heatmap")
+    parser.add_argument('--n_concepts', type=int, default=112)
+    parser.add_argument('--emb_size', type=int, default=16)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--spatial', type=int, default=10, help="height and width of the trunk feature map")
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--atol', type=float, default=1e-10)
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model = ConceptEmbeddingModel(
+        args.n_concepts,
+        n_tasks=5,
+        emb_size=args.emb_size,
+        c_extractor_arch=lambda output_dim: resnet18(),
+        training_intervention_prob=0,
+    ).eval()
+    check_equivalence(model, args.n_concepts, args.emb_size, args.atol)
+    compare_cost(
+        model, args.n_concepts, args.emb_size, args.batch_size, args.spatial, torch.device(args.device), args.repeats
+    )
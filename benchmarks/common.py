@@ -0,0 +1,32 @@
+import time
+import torch
+from torch.profiler import profile, ProfilerActivity
+
+
+def measure_step(step, device, repeats=20, warmup=3):
+    """
+    Average wall-clock time (ms) of `step()` over `repeats` calls, and the memory it allocates in one call (MiB):
+    the peak allocated memory on CUDA, the total of its CPU allocations otherwise.
+    """
+    for _ in range(warmup):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        step()
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    step_time = (time.perf_counter() - start) / repeats * 1000
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        base = torch.cuda.memory_allocated(device)
+        step()
+        torch.cuda.synchronize(device)
+        memory = torch.cuda.max_memory_allocated(device) - base
+    else:
+        with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+            step()
+        memory = sum(max(event.self_cpu_memory_usage, 0) for event in prof.key_averages())
+    return step_time, memory / 2 ** 20
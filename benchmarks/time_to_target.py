@@ -0,0 +1,123 @@
+"""
+Compares the time to a target validation accuracy of training batches drawn by `LabeledQuotaBatchSampler`
+(`labeled_per_batch`) against the plain shuffled loader (`shuffle=True`).
+
+A ConceptBottleneckModel is trained on a synthetic dataset, of which only `--labeled_ratio` of the training samples
+keep their concept labels, the others getting kNN pseudo-concepts as in the dataset loaders. Both loaders see the
+same data, model initialisation and number of batches per epoch; `TimeToTargetAccuracy` records the epoch and the
+wall-clock time at which `--monitor` first reaches `--target`, for every seed, and training stops there. The task
+labels are known for every sample, so the default monitor is the concept accuracy, the one the quota of labeled
+samples per batch acts on.
+
+Run from the repository root: python -m benchmarks.time_to_target
+"""
+import argparse
+import logging
+import numpy as np
+import torch
+import pytorch_lightning as pl
+from torch.utils.data import DataLoader, TensorDataset
+
+from data.neighbors import find_neighbors
+from data.samplers import train_batching
+from data.synthetic_loader import (
+    generate_dot_data, generate_trig_data, generate_xor_data, get_synthetic_extractor_arch, get_synthetic_num_features,
+)
+from data.utils import compute_pseudo_concepts, stratified_labeled_mask
+from models.cbm import ConceptBottleneckModel
+from train.callbacks import TimeToTargetAccuracy
+
+GENERATORS = {'xor': generate_xor_data, 'trig': generate_trig_data, 'dot': generate_dot_data}
+
+
+class StopAtTarget(TimeToTargetAccuracy):
+    """TimeToTargetAccuracy that also ends training once the target is reached."""
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        super().on_validation_epoch_end(trainer, pl_module)
+        if self.epochs_to_target is not None:
+            trainer.should_stop = True
+
+
+def make_split(dataset, size, labeled_ratio, k=8):
+    x, c, y = GENERATORS[dataset](size)
+    # The binary task as two classes, so the task loss and accuracy need no squeezing of the model output
+    y = y.long()
+    l = stratified_labeled_mask(y.numpy(), labeled_ratio)
+    distances, indices = find_neighbors(x.numpy(), l, k, recall_sample=0)
+    weights = 1.0 / (distances + 1e-6)
+    weights = weights / np.sum(weights, axis=1, keepdims=True)
+    c_pseudo = compute_pseudo_concepts(c.numpy(), np.flatnonzero(l), indices, weights)
+    return x, y, c, torch.from_numpy(l), torch.from_numpy(c_pseudo)
+
+
+def time_to_target(train_split, val_split, dataset, batching, args, seed):
+    pl.seed_everything(seed, verbose=False)
+    model = ConceptBottleneckModel(
+        n_concepts=train_split[2].shape[1],
+        n_tasks=2,
+        c_extractor_arch=get_synthetic_extractor_arch(get_synthetic_num_features(dataset)),
+        concept_loss_weight_labeled=args.concept_loss_weight_labeled,
+        concept_loss_weight_unlabeled=args.concept_loss_weight_unlabeled,
+        learning_rate=args.learning_rate,
+    )
+    train_dl = DataLoader(TensorDataset(*train_split), **batching)
+    val_dl = DataLoader(TensorDataset(*val_split), batch_size=len(val_split[0]))
+    callback = StopAtTarget(args.target, monitor=args.monitor)
+    trainer = pl.Trainer(
+        accelerator='cpu',
+        max_epochs=args.max_epochs,
+        callbacks=[callback],
+        logger=False,
+        enable_checkpointing=False,
+        enable_progress_bar=False,
+        enable_model_summary=False,
+    )
+    trainer.fit(model, train_dl, val_dl)
+    return callback.epochs_to_target, callback.time_to_target
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time to target accuracy: labeled_per_batch vs shuffle=True")
+    parser.add_argument('--dataset', default='trig', choices=sorted(GENERATORS))
+    parser.add_argument('--train_size', type=int, default=20000)
+    parser.add_argument('--val_size', type=int, default=2000)
+    parser.add_argument('--labeled_ratio', type=float, default=0.01)
+    parser.add_argument('--batch_size', type=int, default=256)
+    parser.add_argument('--labeled_per_batch', type=int, default=32)
+    parser.add_argument('--concept_loss_weight_labeled', type=float, default=1.)
+    parser.add_argument('--concept_loss_weight_unlabeled', type=float, default=0.1)
+    parser.add_argument('--learning_rate', type=float, default=0.0001)
+    parser.add_argument('--monitor', default='val_c_acc')
+    parser.add_argument('--target', type=float, default=0.92)
+    parser.add_argument('--max_epochs', type=int, default=20)
+    parser.add_argument('--seeds', type=int, nargs='+', default=[0, 1, 2, 3, 4])
+    args = parser.parse_args()
+    logging.getLogger('pytorch_lightning').setLevel(logging.ERROR)
+
+    pl.seed_everything(0, verbose=False)
+    train_split = make_split(args.dataset, args.train_size, args.labeled_ratio)
+    val_split = make_split(args.dataset, args.val_size, 1.)
+    labeled_mask = train_split[3].numpy()
+    loaders = {
+        'shuffle': lambda seed: train_batching(labeled_mask, args.batch_size, seed=seed),
+        'labeled_per_batch': lambda seed: train_batching(
+            labeled_mask, args.batch_size, seed=seed, labeled_per_batch=args.labeled_per_batch
+        ),
+    }
+
+    print(f"{args.monitor} >= {args.target}, {labeled_mask.sum()} labeled of {len(labeled_mask)} training samples")
+    for name, batching in loaders.items():
+        results = [
+            time_to_target(train_split, val_split, args.dataset, batching(seed), args, seed) for seed in args.seeds
+        ]
+        for seed, (epochs, seconds) in zip(args.seeds, results):
+            if epochs is None:
+                print(f"{name:>17} seed {seed}: not reached in {args.max_epochs} epochs")
+            else:
+                print(f"{name:>17} seed {seed}: {epochs:3d} epochs, {seconds:7.2f} s")
+        reached = [result for result in results if result[0] is not None]
+        if reached:
+            print(f"{name:>17} median: {np.median([epochs for epochs, _ in reached]):5.1f} epochs, "
+                  f"{np.median([seconds for _, seconds in reached]):7.2f} s "
+                  f"({len(reached)}/{len(results)} seeds reached the target)")
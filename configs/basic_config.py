@@ -31,6 +31,10 @@ def get_args():
         type=float,
         default=0.1,
         help='The proportion of the labeled data')
+    parser.add_argument(
+        '--rebuild_data',
+        action='store_true',
+        help='Discard the prepared dataset snapshot, if a snapshot_dir is configured, and prepare the data again')
 
     # Operation environment
     parser.add_argument(
@@ -0,0 +1,71 @@
+import torch
+from torch.utils.data import DataLoader
+
+
+class BatchedAugmentation(object):
+    """
+    Batched tensor version of `ColorJitter(brightness, saturation)`, `RandomHorizontalFlip()` and
+    `Normalize(mean, std)` for uint8 [B, 3, H, W] image batches.
+
+    Every sample draws its own brightness and saturation factors, its own order for the two jitters (as
+    `ColorJitter` does) and its own flip, from the same distributions as the per-image torchvision transforms.
+    Both jitters are per-pixel, so applying them after `RandomResizedCrop` instead of before it only differs from the
+    PIL pipeline by rounding and clamping.
+    """
+
+    def __init__(self, brightness=32 / 255, saturation=(0.5, 1.5), flip_p=0.5, mean=(0.5, 0.5, 0.5), std=(2, 2, 2)):
+        self.brightness = (max(0., 1 - brightness), 1 + brightness)
+        self.saturation = saturation
+        self.flip_p = flip_p
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    @staticmethod
+    def _uniform(low, high, n, device):
+        return torch.empty(n, 1, 1, 1, device=device).uniform_(low, high)
+
+    @staticmethod
+    def _adjust_brightness(x, factor):
+        return (x * factor).clamp(0, 1)
+
+    @staticmethod
+    def _adjust_saturation(x, factor):
+        gray = (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+        return (factor * x + (1 - factor) * gray).clamp(0, 1)
+
+    def __call__(self, imgs):
+        x = imgs.float() / 255
+        n, device = len(x), x.device
+        brightness = self._uniform(*self.brightness, n, device)
+        saturation = self._uniform(*self.saturation, n, device)
+
+        brightness_first = torch.rand(n, device=device) < 0.5
+        x = torch.where(
+            brightness_first.view(-1, 1, 1, 1),
+            self._adjust_saturation(self._adjust_brightness(x, brightness), saturation),
+            self._adjust_brightness(self._adjust_saturation(x, saturation), brightness),
+        )
+
+        flip = torch.rand(n, device=device) < self.flip_p
+        x = torch.where(flip.view(-1, 1, 1, 1), x.flip(-1), x)
+        return (x - self.mean.to(device)) / self.std.to(device)
+
+
+class BatchTransformDataLoader(DataLoader):
+    """
+    DataLoader that applies `batch_transform` to the images (first element) of every collated batch in the main
+    process, after moving them to `augment_device` when given, so the transform runs once per batch rather than
+    once per sample in the workers.
+    """
+
+    def __init__(self, *args, batch_transform=None, augment_device=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_transform = batch_transform
+        self.augment_device = augment_device
+
+    def __iter__(self):
+        for batch in super().__iter__():
+            x = batch[0]
+            if self.augment_device is not None:
+                x = x.to(self.augment_device, non_blocking=True)
+            yield (self.batch_transform(x), *batch[1:])
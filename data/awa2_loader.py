@@ -4,81 +4,85 @@ import numpy as np
 import os
 import torch
 from tqdm import tqdm
-from collections import defaultdict
 import random
 import logging
 from torchvision.models import resnet50
-from sklearn.neighbors import NearestNeighbors
 from torch.utils.data import Dataset, DataLoader, random_split
 
+from data.features import extract_features
+from data.image_cache import ImageCache
+from data.neighbors import find_neighbors
+from data.samplers import batching_options, train_batching
+from data.shards import DATA_BACKENDS, sharded_dataset
+from data.snapshot import snapshot_cached
+from data.utils import compute_pseudo_concepts, concept_imbalance, encode_pseudo_concepts, get_image_paths, \
+    get_label_index, pseudo_concepts_to_float, stratified_labeled_mask
+
 
 class CelebaDataset(Dataset):
     def __init__(self, ds, labeled_ratio, training,
                  seed=42, transform=None,
-                 concept_transform=None, label_transform=None):
+                 concept_transform=None, label_transform=None, num_workers=0, pseudo_dtype='float32', knn_backend='exact', knn_params=None,
+                 snapshot=None, snapshot_entry=None):
         self.ds = ds
+        self.num_workers = num_workers
+        self.knn_backend = knn_backend
+        self.knn_params = knn_params or {}
         self.transform = transform
         self.concept_transform = concept_transform
         self.label_transform = label_transform
-        self.l_choice = defaultdict(bool)
+
+        prepared = snapshot_cached(
+            snapshot, snapshot_entry, lambda: self._prepare_semi_supervision(labeled_ratio, training, pseudo_dtype)
+        )
+        self.class_labels, self.concepts = prepared['class_labels'], prepared['concepts']
+        self.l_choice, self.c_pseudo = prepared['l_choice'], prepared['c_pseudo']
+        logging.info(f"actual labeled ratio: {np.mean(self.l_choice)}")
+
+    def _prepare_semi_supervision(self, labeled_ratio, training, pseudo_dtype):
+        # Class ids and concepts come from the wrapped dataset's metadata, so no image is decoded for them
+        class_labels, concepts = get_label_index(self.ds)
+        if self.concept_transform is not None:
+            concepts = np.stack([self.concept_transform(c) for c in concepts])
+        concepts = np.asarray(concepts, dtype=np.float32)
 
         if training:
-            random.seed(seed)
-            class_count = defaultdict(int)
-            for img_data in self.ds:
-                class_count[img_data[1][0].item()] += 1
-
-            labeled_count = defaultdict(int)
-            for idx, img_data in enumerate(self.ds):
-                class_label = img_data[1][0].item()
-                if labeled_count[class_label] < labeled_ratio * class_count[class_label]:
-                    self.l_choice[idx] = True
-                    labeled_count[class_label] += 1
-                else:
-                    self.l_choice[idx] = False
+            self.l_choice = stratified_labeled_mask(class_labels, labeled_ratio)
         else:
-            for idx in range(len(self.ds)):
-                self.l_choice[idx] = True
-
-        count = 0
-        for idx in range(len(self.l_choice)):
-            if self.l_choice[idx]:
-                count += 1
-        logging.info(f"actual labeled ratio: {count / len(self.l_choice)}")
+            self.l_choice = np.ones(len(self.ds), dtype=bool)
 
-        self.neighbor = self.nearest_neighbors_resnet(k=2)
+        if np.all(self.l_choice):
+            # Pseudo-concepts are only used for unlabeled samples, so the true concepts stand in for them and no
+            # feature is extracted nor neighbour searched
+            c_pseudo = encode_pseudo_concepts(concepts, pseudo_dtype)
+        else:
+            nbr_indices, nbr_weights = self.nearest_neighbors_resnet(k=2)
+            labeled_idxs = np.flatnonzero(self.l_choice)
+            c_pseudo = compute_pseudo_concepts(concepts, labeled_idxs, nbr_indices, nbr_weights, dtype=pseudo_dtype)
+        return {'class_labels': class_labels, 'concepts': concepts, 'l_choice': self.l_choice, 'c_pseudo': c_pseudo}
 
     def nearest_neighbors_resnet(self, k=3):
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         model = resnet50(pretrained=True).to(device)
         model.eval()
-        imgs = []
-        for d in self.ds:
-            imgs.append(d[0][None, :, :, :])
-        imgs_tensor = torch.cat(imgs, dim=0)
-        imgs_tensor = imgs_tensor.to(device)
-        num_chunks = 10
-        chunked_tensors = torch.chunk(imgs_tensor, num_chunks, dim=0)
-
-        features = []
-        with torch.no_grad():
-            for chunk in tqdm(chunked_tensors):
-                features.append(model(chunk))
-        features = torch.cat(features, dim=0)
-        features = features.detach().cpu().numpy()
-        labeled_features = []
-        for idx in range(len(features)):
-            if self.l_choice[idx]:
-                labeled_features.append(features[idx])
-        labeled_features = np.array(labeled_features)
-        nbrs = NearestNeighbors(n_neighbors=k, metric='cosine')
-        nbrs.fit(labeled_features)
-        distances, indices = nbrs.kneighbors(features)
+        features = extract_features(
+            self.ds,
+            model,
+            np.empty((len(self.ds), 1000), dtype=np.float32),
+            num_workers=self.num_workers,
+        )
+        distances, indices = find_neighbors(features, self.l_choice, k, backend=self.knn_backend, **self.knn_params)
 
         weights = 1.0 / (distances + 1e-6)
         weights = weights / np.sum(weights, axis=1, keepdims=True)
 
-        return [{'indices': idx, 'weights': w} for idx, w in zip(indices, weights)]
+        return indices, weights
+
+    def image_paths(self):
+        return get_image_paths(self.ds)
+
+    def label_index(self):
+        return self.class_labels, self.concepts
 
     def __len__(self):
         return len(self.ds)
@@ -86,35 +90,31 @@ class CelebaDataset(Dataset):
     def __getitem__(self, idx):
         img_data = self.ds[idx]
         l = self.l_choice[idx]
-        neighbor_info = self.neighbor[idx]
-        neighbor_indices = neighbor_info['indices']
-        nbr_concepts = []
-        # print(len(neighbor_indices))
-        for idx in neighbor_indices:
-            # What is the attribute_label?
-            # print(self.ds[idx][1][1])
-            nbr_concepts.append(self.ds[idx][1][1].unsqueeze(0))
-        nbr_concepts = torch.concat(nbr_concepts, dim=0)
-        nbr_weight = torch.from_numpy(neighbor_info['weights'])
+        c_pseudo = torch.from_numpy(pseudo_concepts_to_float(self.c_pseudo[idx]))
 
         class_label = img_data[1][0]
         if self.label_transform:
             class_label = self.label_transform(class_label)
 
-        attr_label = img_data[1][1]
-        if self.concept_transform is not None:
-            attr_label = self.concept_transform(attr_label)
+        attr_label = self.concepts[idx]
+
+        return img_data[0], class_label, torch.tensor(attr_label), torch.tensor(l), c_pseudo
+
 
-        return img_data[0], class_label, torch.tensor(attr_label).to(torch.float32), torch.tensor(
-            l), nbr_concepts, nbr_weight
+def _image_tensor(img):
+    """[3, 299, 299] float tensor in [0, 1] of a decoded image (or of an HWC uint8 array already at 299x299)."""
+    if isinstance(img, Image.Image):
+        img = np.array(img.resize((299, 299)))
+    return torch.tensor(img.transpose() / 255.).to(torch.float32)
 
 
 class RawAwA(Dataset):
-    def __init__(self, img_paths, labels, l2c_dct):
+    def __init__(self, img_paths, labels, l2c_dct, image_cache=None):
         super().__init__()
         self.img_paths = img_paths
         self.labels = labels
         self.l2c_dct = l2c_dct
+        self.image_cache = image_cache
 
     def __len__(self):
         return len(self.img_paths)
@@ -122,14 +122,23 @@ class RawAwA(Dataset):
     def __getitem__(self, idx):
         img_path = self.img_paths[idx]
         label = self.labels[idx]
-        img = Image.open(img_path).convert('RGB').resize((299, 299))
-        img = np.array(img).transpose()
+        if self.image_cache is not None:
+            img = self.image_cache[idx]
+        else:
+            img = Image.open(img_path).convert('RGB')
 
         cs = self.l2c_dct[label, :]
-        return torch.tensor(img / 255.).to(torch.float32), (torch.tensor(label), torch.tensor(cs))
+        return _image_tensor(img), (torch.tensor(label), torch.tensor(cs))
+
+    def image_paths(self):
+        return list(self.img_paths)
+
+    def label_index(self):
+        labels = np.asarray(self.labels, dtype=np.int64)
+        return labels, self.l2c_dct[labels, :].astype(np.float32)
 
 
-def load_data(data_dir, sample=0.05, seed=42):
+def load_data(data_dir, sample=0.05, seed=42, image_cache_dir=None, num_workers=4):
     # sample = 0.002
     classes = []
     with open(os.path.join(data_dir, "classes.txt")) as f:
@@ -165,10 +174,14 @@ def load_data(data_dir, sample=0.05, seed=42):
         sampled_labels.append(labels[i])
     train_size = int(int(size * sample) * 0.8)
     val_size = int(int(size * sample) * 0.1)
-    train_set = RawAwA(sampled_img_paths[:train_size], sampled_labels[:train_size], cs_matrix)
-    val_set = RawAwA(sampled_img_paths[train_size:train_size + val_size],
-                     sampled_labels[train_size:train_size + val_size], cs_matrix)
-    test_set = RawAwA(sampled_img_paths[train_size + val_size:], sampled_labels[train_size + val_size:], cs_matrix)
+    splits = []
+    for start, end in [(0, train_size), (train_size, train_size + val_size), (train_size + val_size, None)]:
+        split_img_paths, split_labels = sampled_img_paths[start:end], sampled_labels[start:end]
+        image_cache = None
+        if image_cache_dir is not None:
+            image_cache = ImageCache(split_img_paths, image_cache_dir, size=(299, 299), num_workers=num_workers)
+        splits.append(RawAwA(split_img_paths, split_labels, cs_matrix, image_cache=image_cache))
+    train_set, val_set, test_set = splits
     return train_set, val_set, test_set
 
 
@@ -176,23 +189,71 @@ def generate_data(
         config,
         labeled_ratio=0.1,
         seed=42,
+        snapshot=None,
 ):
     celeba_train_data, celeba_val_data, celeba_test_data = load_data(
         data_dir=config['root_dir'],
-        seed=seed
+        seed=seed,
+        image_cache_dir=config.get('image_cache_dir'),
+        num_workers=config['num_workers'],
     )
 
+    data_backend = config.get('data_backend', 'files')
+    if data_backend not in DATA_BACKENDS:
+        raise ValueError(f"Unsupported data backend {data_backend}, expected one of {list(DATA_BACKENDS)}")
+
     celeba_train_data = CelebaDataset(celeba_train_data, labeled_ratio=labeled_ratio,
-                                      training=True, seed=seed)
-    celeba_val_data = CelebaDataset(celeba_val_data, labeled_ratio=1., training=False, seed=seed)
-    celeba_test_data = CelebaDataset(celeba_test_data, labeled_ratio=1., training=False, seed=seed)
+                                      training=True, seed=seed, num_workers=config['num_workers'],
+                                      pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+                                      knn_backend=config.get('knn_backend', 'exact'),
+                                      knn_params=config.get('knn_params'),
+                                      snapshot=snapshot, snapshot_entry='train')
+    celeba_val_data = CelebaDataset(celeba_val_data, labeled_ratio=1., training=False, seed=seed,
+                                    num_workers=config['num_workers'],
+                                    pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+                                    knn_backend=config.get('knn_backend', 'exact'),
+                                    knn_params=config.get('knn_params'),
+                                    snapshot=snapshot, snapshot_entry='val')
+    celeba_test_data = CelebaDataset(celeba_test_data, labeled_ratio=1., training=False, seed=seed,
+                                     num_workers=config['num_workers'],
+                                     pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+                                     knn_backend=config.get('knn_backend', 'exact'),
+                                     knn_params=config.get('knn_params'),
+                                     snapshot=snapshot, snapshot_entry='test')
 
-    train_dl = torch.utils.data.DataLoader(
-        celeba_train_data,
-        batch_size=config['batch_size'],
-        shuffle=True,
-        num_workers=config['num_workers'],
-    )
+    shuffle_train = True
+    if data_backend == 'shards':
+        # Stream the images sequentially from tar shards instead of reading one file per sample
+        shard_dir = config.get('shard_dir', os.path.join(config['root_dir'], 'shards'))
+        celeba_train_data, celeba_val_data, celeba_test_data = [
+            sharded_dataset(
+                ds,
+                shard_dir,
+                transform=_image_tensor,
+                shuffle=training,
+                shard_size=config.get('shard_size', 1000),
+                shuffle_buffer=config.get('shuffle_buffer', 1000),
+            )
+            for ds, training in [(celeba_train_data, True), (celeba_val_data, False), (celeba_test_data, False)]
+        ]
+        shuffle_train = False
+
+    batching = batching_options(config)
+    if batching is not None:
+        if data_backend == 'shards':
+            raise ValueError("Training samplers cannot be combined with streamed shards")
+        train_dl = torch.utils.data.DataLoader(
+            celeba_train_data,
+            num_workers=config['num_workers'],
+            **train_batching(celeba_train_data.l_choice, config['batch_size'], seed=seed, **batching),
+        )
+    else:
+        train_dl = torch.utils.data.DataLoader(
+            celeba_train_data,
+            batch_size=config['batch_size'],
+            shuffle=shuffle_train,
+            num_workers=config['num_workers'],
+        )
     test_dl = torch.utils.data.DataLoader(
         celeba_test_data,
         batch_size=config['batch_size'],
@@ -210,13 +271,9 @@ def generate_data(
     # factors
     num_concepts = 85
     if config.get('weight_loss', False):
-        attribute_count = np.zeros((num_concepts,))
-        samples_seen = 0
-        for i, (_, (y, c)) in enumerate(train_dl):
-            c = c.cpu().detach().numpy()
-            attribute_count += np.sum(c, axis=0)
-            samples_seen += c.shape[0]
-        imbalance = samples_seen / attribute_count - 1
+        imbalance = snapshot_cached(
+            snapshot, 'imbalance', lambda: {'imbalance': concept_imbalance(get_label_index(celeba_train_data)[1])}
+        )['imbalance']
     else:
         imbalance = None
     # if not output_dataset_vars:
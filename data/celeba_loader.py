@@ -4,14 +4,20 @@ import torch
 import torchvision
 from torch.utils.data import Dataset
 from tqdm import tqdm
-from collections import defaultdict
 
 import random
 import logging
 from torchvision.models import resnet50
-from sklearn.neighbors import NearestNeighbors
 from torch.utils.data import Dataset, DataLoader, random_split
 
+from data.features import extract_features
+from data.neighbors import find_neighbors
+from data.samplers import batching_options, train_batching
+from data.shards import DATA_BACKENDS, sharded_dataset
+from data.snapshot import snapshot_cached
+from data.utils import compute_pseudo_concepts, concept_imbalance, encode_pseudo_concepts, get_image_paths, \
+    get_label_index, pseudo_concepts_to_float, stratified_labeled_mask
+
 from pathlib import Path
 from pytorch_lightning import seed_everything
 from torchvision import transforms
@@ -100,73 +106,88 @@ CONCEPT_SEMANTICS = [
 # Self-defined Dataset
 ##########################################################\
 
+class LabeledCelebA(torchvision.datasets.CelebA):
+    def image_paths(self):
+        return [os.path.join(self.root, self.base_folder, "img_align_celeba", name) for name in self.filename]
+
+    def label_index(self):
+        # Built from the identity/attr tables through the same target transform as __getitem__, without
+        # reading any image
+        if getattr(self, '_label_index', None) is None:
+            targets = [
+                self.target_transform((self.identity[idx, 0], self.attr[idx, :]))
+                for idx in range(len(self.attr))
+            ]
+            class_labels = np.array([int(target[0]) for target in targets], dtype=np.int64)
+            concepts = np.stack([target[1].cpu().detach().numpy() for target in targets]).astype(np.float32)
+            self._label_index = (class_labels, concepts)
+        return self._label_index
+
+
 class CelebaDataset(Dataset):
     def __init__(self, ds, labeled_ratio, training,
                  seed=42, transform=None,
-                 concept_transform=None, label_transform=None):
+                 concept_transform=None, label_transform=None, num_workers=0, pseudo_dtype='float32', knn_backend='exact', knn_params=None,
+                 snapshot=None, snapshot_entry=None):
         self.ds = ds
+        self.num_workers = num_workers
+        self.knn_backend = knn_backend
+        self.knn_params = knn_params or {}
         self.transform = transform
         self.concept_transform = concept_transform
         self.label_transform = label_transform
-        self.l_choice = defaultdict(bool)
+
+        prepared = snapshot_cached(
+            snapshot, snapshot_entry, lambda: self._prepare_semi_supervision(labeled_ratio, training, pseudo_dtype)
+        )
+        self.class_labels, self.concepts = prepared['class_labels'], prepared['concepts']
+        self.l_choice, self.c_pseudo = prepared['l_choice'], prepared['c_pseudo']
+        logging.info(f"actual labeled ratio: {np.mean(self.l_choice)}")
+
+    def _prepare_semi_supervision(self, labeled_ratio, training, pseudo_dtype):
+        # Class ids and concepts come from the wrapped dataset's metadata, so no image is decoded for them
+        class_labels, concepts = get_label_index(self.ds)
+        if self.concept_transform is not None:
+            concepts = np.stack([self.concept_transform(c) for c in concepts])
+        concepts = np.asarray(concepts, dtype=np.float32)
 
         if training:
-            random.seed(seed)
-            class_count = defaultdict(int)
-            for img_data in self.ds:
-                class_count[img_data[1][0].item()] += 1
-
-            labeled_count = defaultdict(int)
-            for idx, img_data in enumerate(self.ds):
-                class_label = img_data[1][0].item()
-                if labeled_count[class_label] < labeled_ratio * class_count[class_label]:
-                    self.l_choice[idx] = True
-                    labeled_count[class_label] += 1
-                else:
-                    self.l_choice[idx] = False
+            self.l_choice = stratified_labeled_mask(class_labels, labeled_ratio)
         else:
-            for idx in range(len(self.ds)):
-                self.l_choice[idx] = True
+            self.l_choice = np.ones(len(self.ds), dtype=bool)
 
-        count = 0
-        for idx in range(len(self.l_choice)):
-            if self.l_choice[idx]:
-                count += 1
-        logging.info(f"actual labeled ratio: {count / len(self.l_choice)}")
-
-        self.neighbor = self.nearest_neighbors_resnet(k=2)
+        if np.all(self.l_choice):
+            # Pseudo-concepts are only used for unlabeled samples, so the true concepts stand in for them and no
+            # feature is extracted nor neighbour searched
+            c_pseudo = encode_pseudo_concepts(concepts, pseudo_dtype)
+        else:
+            nbr_indices, nbr_weights = self.nearest_neighbors_resnet(k=2)
+            labeled_idxs = np.flatnonzero(self.l_choice)
+            c_pseudo = compute_pseudo_concepts(concepts, labeled_idxs, nbr_indices, nbr_weights, dtype=pseudo_dtype)
+        return {'class_labels': class_labels, 'concepts': concepts, 'l_choice': self.l_choice, 'c_pseudo': c_pseudo}
 
     def nearest_neighbors_resnet(self, k=3):
         device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
         model = resnet50(pretrained=True).to(device)
         model.eval()
-        imgs = []
-        for d in self.ds:
-            imgs.append(d[0][None, :, :, :])
-        imgs_tensor = torch.cat(imgs, dim=0)
-        imgs_tensor = imgs_tensor.to(device)
-        num_chunks = 10
-        chunked_tensors = torch.chunk(imgs_tensor, num_chunks, dim=0)
-
-        features = []
-        with torch.no_grad():
-            for chunk in tqdm(chunked_tensors):
-                features.append(model(chunk))
-        features = torch.cat(features, dim=0)
-        features = features.detach().cpu().numpy()
-        labeled_features = []
-        for idx in range(len(features)):
-            if self.l_choice[idx]:
-                labeled_features.append(features[idx])
-        labeled_features = np.array(labeled_features)
-        nbrs = NearestNeighbors(n_neighbors=k, metric='cosine')
-        nbrs.fit(labeled_features)
-        distances, indices = nbrs.kneighbors(features)
+        features = extract_features(
+            self.ds,
+            model,
+            np.empty((len(self.ds), 1000), dtype=np.float32),
+            num_workers=self.num_workers,
+        )
+        distances, indices = find_neighbors(features, self.l_choice, k, backend=self.knn_backend, **self.knn_params)
 
         weights = 1.0 / (distances + 1e-6)
         weights = weights / np.sum(weights, axis=1, keepdims=True)
 
-        return [{'indices': idx, 'weights': w} for idx, w in zip(indices, weights)]
+        return indices, weights
+
+    def image_paths(self):
+        return get_image_paths(self.ds)
+
+    def label_index(self):
+        return self.class_labels, self.concepts
 
     def __len__(self):
         return len(self.ds)
@@ -174,26 +195,15 @@ class CelebaDataset(Dataset):
     def __getitem__(self, idx):
         img_data = self.ds[idx]
         l = self.l_choice[idx]
-        neighbor_info = self.neighbor[idx]
-        neighbor_indices = neighbor_info['indices']
-        nbr_concepts = []
-        # print(len(neighbor_indices))
-        for idx in neighbor_indices:
-            # What is the attribute_label?
-            # print(self.ds[idx][1][1])
-            nbr_concepts.append(self.ds[idx][1][1].unsqueeze(0))
-        nbr_concepts = torch.concat(nbr_concepts, dim=0)
-        nbr_weight = torch.from_numpy(neighbor_info['weights'])
+        c_pseudo = torch.from_numpy(pseudo_concepts_to_float(self.c_pseudo[idx]))
 
         class_label = img_data[1][0]
         if self.label_transform:
             class_label = self.label_transform(class_label)
 
-        attr_label = img_data[1][1]
-        if self.concept_transform is not None:
-            attr_label = self.concept_transform(attr_label)
+        attr_label = self.concepts[idx]
 
-        return img_data[0], class_label, torch.FloatTensor(attr_label), torch.tensor(l), nbr_concepts, nbr_weight
+        return img_data[0], class_label, torch.tensor(attr_label), torch.tensor(l), c_pseudo
 
 
 ##########################################################
@@ -206,10 +216,21 @@ def generate_data(
         labeled_ratio=0.1,
         seed=42,
         output_dataset_vars=False,
+        snapshot=None,
 ):
     root_dir = './data/CelebA/'
     concept_group_map = None
     seed_everything(seed)
+    data_backend = config.get('data_backend', 'files')
+    if data_backend not in DATA_BACKENDS:
+        raise ValueError(f"Unsupported data backend {data_backend}, expected one of {list(DATA_BACKENDS)}")
+    image_transform = transforms.Compose([
+        transforms.Resize(config['image_size']),
+        transforms.CenterCrop(config['image_size']),
+        transforms.ToTensor(),
+        transforms.ConvertImageDtype(torch.float32),
+        transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+    ])
     use_binary_vector_class = config.get('use_binary_vector_class', False)
     if use_binary_vector_class:
         width = config.get('label_binary_width', 5)
@@ -262,13 +283,7 @@ def generate_data(
             root=root_dir,
             split='all',
             download=True,
-            transform=transforms.Compose([
-                transforms.Resize(config['image_size']),
-                transforms.CenterCrop(config['image_size']),
-                transforms.ToTensor(),
-                transforms.ConvertImageDtype(torch.float32),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]),
+            transform=image_transform,
             target_transform=lambda x: [
                 torch.tensor(
                     _binarize(
@@ -283,7 +298,7 @@ def generate_data(
             target_type=['identity', 'attr'],
         )
         label_remap = {}
-        vals, counts = np.unique(
+        vals = snapshot_cached(snapshot, 'binary_labels', lambda: {'vals': np.unique(
             list(map(
                 lambda x: _binarize(
                     x.cpu().detach().numpy(),
@@ -292,22 +307,15 @@ def generate_data(
                 ),
                 celeba_train_data.attr
             )),
-            return_counts=True,
-        )
-        for i, label in enumerate(vals):
+        )})['vals']
+        for i, label in enumerate(vals.tolist()):
             label_remap[label] = i
 
-        celeba_train_data = torchvision.datasets.CelebA(
+        celeba_train_data = LabeledCelebA(
             root=root_dir,
             split='all',
             download=True,
-            transform=transforms.Compose([
-                transforms.Resize(config['image_size']),
-                transforms.CenterCrop(config['image_size']),
-                transforms.ToTensor(),
-                transforms.ConvertImageDtype(torch.float32),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]),
+            transform=image_transform,
             target_transform=lambda x: [
                 torch.tensor(
                     label_remap[_binarize(
@@ -375,17 +383,11 @@ def generate_data(
             label_remap[label] = i
 
         # Now reload by transform the labels accordingly
-        celeba_train_data = torchvision.datasets.CelebA(
+        celeba_train_data = LabeledCelebA(
             root=root_dir,
             split='all',
             download=True,
-            transform=transforms.Compose([
-                transforms.Resize(config['image_size']),
-                transforms.CenterCrop(config['image_size']),
-                transforms.ToTensor(),
-                transforms.ConvertImageDtype(torch.float32),
-                transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
-            ]),
+            transform=image_transform,
             target_transform=lambda x: [
                 torch.tensor(
                     # If it is not in our map, then we make it be the token
@@ -403,12 +405,12 @@ def generate_data(
         )
         num_classes = config['num_classes']
 
-        train_idxs = np.where(
+        train_idxs = snapshot_cached(snapshot, 'selected_identities', lambda: {'train_idxs': np.where(
             list(map(
                 lambda x: x.cpu().detach().item() - 1 in label_remap,
                 celeba_train_data.identity
             ))
-        )[0]
+        )[0]})['train_idxs']
         celeba_train_data = torch.utils.data.Subset(
             celeba_train_data,
             train_idxs,
@@ -428,16 +430,57 @@ def generate_data(
         )
 
     celeba_train_data = CelebaDataset(celeba_train_data, labeled_ratio=labeled_ratio,
-                                      training=True, seed=seed)
-    celeba_val_data = CelebaDataset(celeba_val_data, labeled_ratio=1., training=False, seed=seed)
-    celeba_test_data = CelebaDataset(celeba_test_data, labeled_ratio=1., training=False, seed=seed)
-
-    train_dl = torch.utils.data.DataLoader(
-        celeba_train_data,
-        batch_size=config['batch_size'],
-        shuffle=True,
-        num_workers=config['num_workers'],
-    )
+                                      training=True, seed=seed, num_workers=config['num_workers'],
+                                      pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+                                      knn_backend=config.get('knn_backend', 'exact'),
+                                      knn_params=config.get('knn_params'),
+                                      snapshot=snapshot, snapshot_entry='train')
+    celeba_val_data = CelebaDataset(celeba_val_data, labeled_ratio=1., training=False, seed=seed,
+                                    num_workers=config['num_workers'],
+                                    pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+                                    knn_backend=config.get('knn_backend', 'exact'),
+                                    knn_params=config.get('knn_params'),
+                                    snapshot=snapshot, snapshot_entry='val')
+    celeba_test_data = CelebaDataset(celeba_test_data, labeled_ratio=1., training=False, seed=seed,
+                                     num_workers=config['num_workers'],
+                                     pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+                                     knn_backend=config.get('knn_backend', 'exact'),
+                                     knn_params=config.get('knn_params'),
+                                     snapshot=snapshot, snapshot_entry='test')
+
+    shuffle_train = True
+    if data_backend == 'shards':
+        # Stream the images sequentially from tar shards instead of reading one file per sample
+        shard_dir = config.get('shard_dir', os.path.join(root_dir, 'shards'))
+        celeba_train_data, celeba_val_data, celeba_test_data = [
+            sharded_dataset(
+                ds,
+                shard_dir,
+                transform=image_transform,
+                shuffle=training,
+                shard_size=config.get('shard_size', 1000),
+                shuffle_buffer=config.get('shuffle_buffer', 1000),
+            )
+            for ds, training in [(celeba_train_data, True), (celeba_val_data, False), (celeba_test_data, False)]
+        ]
+        shuffle_train = False
+
+    batching = batching_options(config)
+    if batching is not None:
+        if data_backend == 'shards':
+            raise ValueError("Training samplers cannot be combined with streamed shards")
+        train_dl = torch.utils.data.DataLoader(
+            celeba_train_data,
+            num_workers=config['num_workers'],
+            **train_batching(celeba_train_data.l_choice, config['batch_size'], seed=seed, **batching),
+        )
+    else:
+        train_dl = torch.utils.data.DataLoader(
+            celeba_train_data,
+            batch_size=config['batch_size'],
+            shuffle=shuffle_train,
+            num_workers=config['num_workers'],
+        )
     test_dl = torch.utils.data.DataLoader(
         celeba_test_data,
         batch_size=config['batch_size'],
@@ -454,13 +497,9 @@ def generate_data(
     # Finally, determine whether or not we will need to compute the imbalance
     # factors
     if config.get('weight_loss', False):
-        attribute_count = np.zeros((num_concepts,))
-        samples_seen = 0
-        for i, (_, (y, c)) in enumerate(train_dl):
-            c = c.cpu().detach().numpy()
-            attribute_count += np.sum(c, axis=0)
-            samples_seen += c.shape[0]
-        imbalance = samples_seen / attribute_count - 1
+        imbalance = snapshot_cached(
+            snapshot, 'imbalance', lambda: {'imbalance': concept_imbalance(get_label_index(celeba_train_data)[1])}
+        )['imbalance']
     else:
         imbalance = None
     # if not output_dataset_vars:
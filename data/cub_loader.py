@@ -8,11 +8,20 @@ import torchvision.transforms as transforms
 from tqdm import tqdm
 from pytorch_lightning import seed_everything
 from torchvision.models import resnet50
-from sklearn.neighbors import NearestNeighbors
 from collections import defaultdict
 from PIL import Image
 from torch.utils.data import Dataset, DataLoader, random_split
 
+from data.augmentation import BatchedAugmentation, BatchTransformDataLoader
+from data.features import cached_features
+from data.image_cache import ImageCache
+from data.neighbors import find_neighbors
+from data.samplers import batching_options, train_batching
+from data.shards import DATA_BACKENDS, sharded_dataset
+from data.snapshot import snapshot_cached
+from data.utils import compute_pseudo_concepts, encode_pseudo_concepts, pseudo_concepts_to_float, \
+    stratified_labeled_mask
+
 # ====================================
 # GENERAL DATASET GLOBAL VARIABLES
 # ====================================
@@ -665,6 +674,14 @@ for i, concept_name in enumerate(list(
     CONCEPT_GROUP_MAP[group].append(i)
 
 
+def _resolve_img_path(img_path):
+    # The pickled metadata still points at the original authors' machine
+    return img_path.replace(
+        '/juice/scr/scr102/scr/thaonguyen/CUB_supervision/datasets/',
+        './data/CUB_200_2011/'
+    )
+
+
 # ========================================
 # ORIGINAL SAMPLER/CLASSES FROM CBM PAPER
 # ========================================
@@ -722,47 +739,70 @@ class StratifiedSampler(Sampler):
 class CUBDataset(Dataset):
     def __init__(self, pkl_file_paths, image_dir, labeled_ratio, training,
                  seed=42, root_dir='../data/CUB200/', path_transform=None, transform=None,
-                 concept_transform=None, label_transform=None):
-        self.data = []
+                 concept_transform=None, label_transform=None, feature_cache_dir=None, num_workers=1,
+                 pseudo_dtype='float32', knn_backend='exact', knn_params=None, image_cache_dir=None,
+                 image_short_side=None, snapshot=None):
+        data = []
         self.is_train = any(["train" in path for path in pkl_file_paths])
         if not self.is_train:
             assert any([("test" in path) or ("val" in path) for path in pkl_file_paths])
         for file_path in pkl_file_paths:
             with open(file_path, 'rb') as f:
-                self.data.extend(pickle.load(f))
+                data.extend(pickle.load(f))
+
+        # Per-sample metadata is kept in flat NumPy columns rather than a list of dicts, so DataLoader workers
+        # share it with the parent process instead of copying it as reference counts get touched
+        self.img_paths = np.array([_resolve_img_path(img_data['img_path']) for img_data in data])
+        self.class_labels = np.array([img_data['class_label'] for img_data in data], dtype=np.int64)
+        self.attribute_labels = np.array([img_data['attribute_label'] for img_data in data], dtype=np.uint8)
+        concepts = self.attribute_labels
+        if concept_transform is not None:
+            concepts = np.stack([concept_transform(attr_label) for attr_label in concepts])
+        self.concepts = np.asarray(concepts, dtype=np.float32)
+        del data
+
         self.transform = transform
         self.concept_transform = concept_transform
         self.label_transform = label_transform
         self.image_dir = image_dir
         self.root_dir = root_dir
         self.path_transform = path_transform
-        self.l_choice = defaultdict(bool)
+        self.feature_cache_dir = feature_cache_dir
+        self.num_workers = num_workers
+        self.knn_backend = knn_backend
+        self.knn_params = knn_params or {}
+
+        # Optional one-time store of the decoded images, so epochs read pixels from a memmap instead of JPEGs
+        self.image_cache = None
+        if image_cache_dir is not None:
+            self.image_cache = ImageCache(
+                self.img_paths.tolist(),
+                image_cache_dir,
+                short_side=image_short_side,
+                num_workers=num_workers,
+            )
+
+        split = '_'.join(os.path.splitext(os.path.basename(path))[0] for path in pkl_file_paths)
+        prepared = snapshot_cached(
+            snapshot, split, lambda: self._prepare_semi_supervision(labeled_ratio, training, pseudo_dtype)
+        )
+        self.l_choice, self.c_pseudo = prepared['l_choice'], prepared['c_pseudo']
+        logging.info(f"actual labeled ratio: {np.mean(self.l_choice)}")
 
+    def _prepare_semi_supervision(self, labeled_ratio, training, pseudo_dtype):
         if training:
-            random.seed(seed)
-            class_count = defaultdict(int)
-            for img_data in self.data:
-                class_count[img_data['class_label']] += 1
-
-            labeled_count = defaultdict(int)
-            for idx, img_data in enumerate(self.data):
-                class_label = img_data['class_label']
-                if labeled_count[class_label] < labeled_ratio * class_count[class_label]:
-                    self.l_choice[idx] = True
-                    labeled_count[class_label] += 1
-                else:
-                    self.l_choice[idx] = False
+            self.l_choice = stratified_labeled_mask(self.class_labels, labeled_ratio)
         else:
-            for idx in range(len(self.data)):
-                self.l_choice[idx] = True
-
-        count = 0
-        for idx in range(len(self.l_choice)):
-            if self.l_choice[idx]:
-                count += 1
-        logging.info(f"actual labeled ratio: {count / len(self.l_choice)}")
+            self.l_choice = np.ones(len(self), dtype=bool)
 
-        self.neighbor = self.nearest_neighbors_resnet(k=2)
+        if np.all(self.l_choice):
+            # Pseudo-concepts are only used for unlabeled samples, so the true concepts stand in for them and no
+            # feature is extracted nor neighbour searched
+            return {'l_choice': self.l_choice, 'c_pseudo': encode_pseudo_concepts(self.concepts, pseudo_dtype)}
+        nbr_indices, nbr_weights = self.nearest_neighbors_resnet(k=2)
+        labeled_idxs = np.flatnonzero(self.l_choice)
+        c_pseudo = compute_pseudo_concepts(self.concepts, labeled_idxs, nbr_indices, nbr_weights, dtype=pseudo_dtype)
+        return {'l_choice': self.l_choice, 'c_pseudo': c_pseudo}
 
     def nearest_neighbors_resnet(self, k=3):
         preprocess = transforms.Compose([
@@ -776,40 +816,21 @@ class CUBDataset(Dataset):
         model = resnet50(pretrained=True).to(device)
         model.eval()
 
-        imgs = []
-        for img_data in tqdm(self.data):
-            img_path = img_data['img_path']
-            img_path = img_path.replace(
-                '/juice/scr/scr102/scr/thaonguyen/CUB_supervision/datasets/',
-                './data/CUB_200_2011/'
-            )
-            img = Image.open(img_path).convert('RGB')
-            img_tensor = preprocess(img).unsqueeze(0)
-            imgs.append(img_tensor)
-        imgs_tensor = torch.cat(imgs, dim=0)
-        imgs_tensor = imgs_tensor.to(device)
-        num_chunks = 10
-        chunked_tensors = torch.chunk(imgs_tensor, num_chunks, dim=0)
-
-        features = []
-        with torch.no_grad():
-            for chunk in tqdm(chunked_tensors):
-                features.append(model(chunk))
-        features = torch.cat(features, dim=0)
-        features = features.detach().cpu().numpy()
-        labeled_features = []
-        for idx in range(len(features)):
-            if self.l_choice[idx]:
-                labeled_features.append(features[idx])
-        labeled_features = np.array(labeled_features)
-        nbrs = NearestNeighbors(n_neighbors=k, metric='cosine')
-        nbrs.fit(labeled_features)
-        distances, indices = nbrs.kneighbors(features)
+        features = cached_features(
+            self.img_paths.tolist(),
+            model=model,
+            preprocess=preprocess,
+            cache_dir=self.feature_cache_dir,
+            backbone='resnet50',
+            dim=1000,
+            num_workers=self.num_workers,
+        )
+        distances, indices = find_neighbors(features, self.l_choice, k, backend=self.knn_backend, **self.knn_params)
 
         weights = 1.0 / (distances + 1e-6)
         weights = weights / np.sum(weights, axis=1, keepdims=True)
 
-        return [{'indices': idx, 'weights': w} for idx, w in zip(indices, weights)]
+        return indices, weights
 
     def nearest_neighbors_clip(self, k=4):
         import clip
@@ -831,38 +852,31 @@ class CUBDataset(Dataset):
         image_features = extract_image_features(image_path)
         print(image_features.shape)
 
+    def image_paths(self):
+        return self.img_paths.tolist()
+
+    def label_index(self):
+        return self.class_labels, self.concepts
+
     def __len__(self):
-        return len(self.data)
+        return len(self.class_labels)
 
     def __getitem__(self, idx):
-        img_data = self.data[idx]
         l = self.l_choice[idx]
-        neighbor_info = self.neighbor[idx]
-        neighbor_indices = neighbor_info['indices']
-        nbr_concepts = []
-        for idx in neighbor_indices:
-            nbr_concepts.append(self.data[idx]['attribute_label'])
-        nbr_concepts = torch.tensor(nbr_concepts)
-        nbr_weight = torch.from_numpy(neighbor_info['weights'])
-
-        img_path = img_data['img_path']
-        img_path = img_path.replace(
-            '/juice/scr/scr102/scr/thaonguyen/CUB_supervision/datasets/',
-            './data/CUB_200_2011/'
-        )
-        img = Image.open(img_path).convert('RGB')
+        c_pseudo = torch.from_numpy(pseudo_concepts_to_float(self.c_pseudo[idx]))
 
-        class_label = img_data['class_label']
+        if self.image_cache is not None:
+            img = Image.fromarray(self.image_cache[idx])
+        else:
+            img = Image.open(self.img_paths[idx]).convert('RGB')
+
+        class_label = int(self.class_labels[idx])
         if self.label_transform:
             class_label = self.label_transform(class_label)
         if self.transform:
             img = self.transform(img)
 
-        attr_label = img_data['attribute_label']
-        if self.concept_transform is not None:
-            attr_label = self.concept_transform(attr_label)
-
-        return img, class_label, torch.FloatTensor(attr_label), torch.tensor(l), nbr_concepts, nbr_weight
+        return img, class_label, torch.tensor(self.concepts[idx]), torch.tensor(l), c_pseudo
 
 
 class ImbalancedDatasetSampler(torch.utils.data.sampler.Sampler):
@@ -881,22 +895,13 @@ class ImbalancedDatasetSampler(torch.utils.data.sampler.Sampler):
         # draw `len(indices)` samples in each iteration
         self.num_samples = len(self.indices)
 
-        # distribution of classes in the data
-        label_to_count = {}
-        for idx in self.indices:
-            label = self._get_label(dataset, idx)
-            if label in label_to_count:
-                label_to_count[label] += 1
-            else:
-                label_to_count[label] = 1
+        # distribution of classes in the data, and weight for each sample
+        labels = self._get_labels(dataset)[np.asarray(self.indices, dtype=np.int64)]
+        _, inverse, label_counts = np.unique(labels, return_inverse=True, return_counts=True)
+        self.weights = torch.DoubleTensor(1.0 / label_counts[inverse])
 
-        # weight for each sample
-        weights = [1.0 / label_to_count[self._get_label(dataset, idx)]
-                   for idx in self.indices]
-        self.weights = torch.DoubleTensor(weights)
-
-    def _get_label(self, dataset, idx):  # Note: for single attribute data
-        return dataset.data[idx]['attribute_label'][0]
+    def _get_labels(self, dataset):  # Note: for single attribute data
+        return dataset.attribute_labels[:, 0]
 
     def __iter__(self):
         idx = (self.indices[i] for i in torch.multinomial(
@@ -921,16 +926,49 @@ def load_data(
         concept_transform=None,
         label_transform=None,
         path_transform=None,
+        feature_cache_dir=None,
+        pseudo_dtype='float32',
+        knn_backend='exact',
+        knn_params=None,
+        image_cache_dir=None,
+        image_short_side=None,
+        batched_augmentation=False,
+        augment_device=None,
+        snapshot=None,
+        data_backend='files',
+        shard_dir=None,
+        shard_size=1000,
+        shuffle_buffer=1000,
+        batching=None,
 ):
     """
     Note: Inception needs (299,299,3) images with inputs scaled between -1 and 1
     Loads data with transformations applied, and upsample the minority class if
     there is class imbalance and weighted loss is not used
     NOTE: resampling is customized for first attribute only, so change sampler.py if necessary
+    With batched_augmentation, training workers only crop and the rest of the augmentation runs
+    on whole uint8 batches in the main process (on augment_device if given)
+    With data_backend='shards', images are streamed sequentially from tar shards written to shard_dir
+    on first use, in shard order and through a shuffle buffer of shuffle_buffer samples when training
+    batching holds the options of the training sampler (see data.samplers.train_batching)
     """
+    if data_backend not in DATA_BACKENDS:
+        raise ValueError(f"Unsupported data backend {data_backend}, expected one of {list(DATA_BACKENDS)}")
     resized_resol = int(resol * 256 / 224)
     is_training = any(['train.pkl' in f for f in pkl_paths])
-    if is_training:
+    batch_transform = None
+    if is_training and batched_augmentation:
+        transform = transforms.Compose([
+            transforms.RandomResizedCrop(resol),
+            transforms.PILToTensor(),
+        ])
+        batch_transform = BatchedAugmentation(
+            brightness=32 / 255,
+            saturation=(0.5, 1.5),
+            mean=[0.5, 0.5, 0.5],
+            std=[2, 2, 2],
+        )
+    elif is_training:
         transform = transforms.Compose([
             transforms.ColorJitter(brightness=32 / 255, saturation=(0.5, 1.5)),
             transforms.RandomResizedCrop(resol),
@@ -956,6 +994,14 @@ def load_data(
         concept_transform=concept_transform,
         label_transform=label_transform,
         path_transform=path_transform,
+        feature_cache_dir=feature_cache_dir,
+        num_workers=num_workers,
+        pseudo_dtype=pseudo_dtype,
+        knn_backend=knn_backend,
+        knn_params=knn_params,
+        image_cache_dir=image_cache_dir,
+        image_short_side=image_short_side,
+        snapshot=snapshot,
     )
     if is_training:
         drop_last = True
@@ -963,12 +1009,36 @@ def load_data(
     else:
         drop_last = False
         shuffle = False
-    if resampling:
+    if batch_transform is not None:
+        loader_cls = BatchTransformDataLoader
+        loader_kwargs = dict(batch_transform=batch_transform, augment_device=augment_device)
+    else:
+        loader_cls = DataLoader
+        loader_kwargs = {}
+    if is_training and batching is not None:
+        if resampling or data_backend == 'shards':
+            raise ValueError("Training samplers cannot be combined with resampling or with streamed shards")
+        loader_kwargs.update(train_batching(dataset.l_choice, batch_size, drop_last=drop_last, seed=seed, **batching))
+        loader = loader_cls(dataset, num_workers=num_workers, **loader_kwargs)
+    elif data_backend == 'shards':
+        if resampling:
+            raise ValueError("Resampling is not supported when streaming shards")
+        dataset = sharded_dataset(
+            dataset,
+            shard_dir,
+            transform=transform,
+            shuffle=shuffle,
+            shard_size=shard_size,
+            shuffle_buffer=shuffle_buffer,
+        )
+        loader = loader_cls(dataset, batch_size=batch_size, drop_last=drop_last, num_workers=num_workers,
+                            **loader_kwargs)
+    elif resampling:
         sampler = StratifiedSampler(ImbalancedDatasetSampler(dataset), batch_size=batch_size)
-        loader = DataLoader(dataset, batch_sampler=sampler, num_workers=num_workers)
+        loader = loader_cls(dataset, batch_sampler=sampler, num_workers=num_workers, **loader_kwargs)
     else:
-        loader = DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
-                            num_workers=num_workers)
+        loader = loader_cls(dataset, batch_size=batch_size, shuffle=shuffle, drop_last=drop_last,
+                            num_workers=num_workers, **loader_kwargs)
     return loader
 
 
@@ -1016,14 +1086,17 @@ def generate_data(
         config,
         labeled_ratio=0.1,
         seed=42,
-        rerun=False
+        rerun=False,
+        snapshot=None,
 ):
     root_dir = config['root_dir']
     base_dir = os.path.join(root_dir, 'class_attr_data_10')
     seed_everything(seed)
     train_data_path = os.path.join(base_dir, 'train.pkl')
     if config.get('weight_loss', False):
-        imbalance = find_class_imbalance(train_data_path, True)
+        imbalance = snapshot_cached(
+            snapshot, 'imbalance', lambda: {'imbalance': np.array(find_class_imbalance(train_data_path, True))}
+        )['imbalance']
     else:
         imbalance = None
 
@@ -1109,6 +1182,10 @@ def generate_data(
     else:
         concept_transform = None
 
+    # Backbone features used for the kNN pseudo-labels are stored on disk and reused across runs
+    feature_cache_dir = config.get('feature_cache_dir', os.path.join(root_dir, 'feature_cache'))
+    shard_dir = config.get('shard_dir', os.path.join(root_dir, 'shards'))
+
     train_dl = load_data(
         labeled_ratio=labeled_ratio,
         seed=seed,
@@ -1120,6 +1197,20 @@ def generate_data(
         root_dir=root_dir,
         num_workers=config['num_workers'],
         concept_transform=concept_transform,
+        feature_cache_dir=feature_cache_dir,
+        pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+        knn_backend=config.get('knn_backend', 'exact'),
+        knn_params=config.get('knn_params'),
+        image_cache_dir=config.get('image_cache_dir'),
+        image_short_side=config.get('image_short_side'),
+        batched_augmentation=config.get('batched_augmentation', False),
+        augment_device=config.get('augment_device'),
+        batching=batching_options(config),
+        snapshot=snapshot,
+        data_backend=config.get('data_backend', 'files'),
+        shard_dir=shard_dir,
+        shard_size=config.get('shard_size', 1000),
+        shuffle_buffer=config.get('shuffle_buffer', 1000),
     )
     val_dl = load_data(
         labeled_ratio=labeled_ratio,
@@ -1132,6 +1223,17 @@ def generate_data(
         root_dir=root_dir,
         num_workers=config['num_workers'],
         concept_transform=concept_transform,
+        feature_cache_dir=feature_cache_dir,
+        pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+        knn_backend=config.get('knn_backend', 'exact'),
+        knn_params=config.get('knn_params'),
+        image_cache_dir=config.get('image_cache_dir'),
+        image_short_side=config.get('image_short_side'),
+        snapshot=snapshot,
+        data_backend=config.get('data_backend', 'files'),
+        shard_dir=shard_dir,
+        shard_size=config.get('shard_size', 1000),
+        shuffle_buffer=config.get('shuffle_buffer', 1000),
     )
 
     test_dl = load_data(
@@ -1145,6 +1247,17 @@ def generate_data(
         root_dir=root_dir,
         num_workers=config['num_workers'],
         concept_transform=concept_transform,
+        feature_cache_dir=feature_cache_dir,
+        pseudo_dtype=config.get('pseudo_dtype', 'float32'),
+        knn_backend=config.get('knn_backend', 'exact'),
+        knn_params=config.get('knn_params'),
+        image_cache_dir=config.get('image_cache_dir'),
+        image_short_side=config.get('image_short_side'),
+        snapshot=snapshot,
+        data_backend=config.get('data_backend', 'files'),
+        shard_dir=shard_dir,
+        shard_size=config.get('shard_size', 1000),
+        shuffle_buffer=config.get('shuffle_buffer', 1000),
     )
 
     return train_dl, val_dl, test_dl, imbalance, (n_concepts, N_CLASSES, concept_group_map)
@@ -0,0 +1,176 @@
+import os
+import json
+import torch
+import hashlib
+import logging
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+
+class ImagePathDataset(Dataset):
+    def __init__(self, img_paths, transform):
+        self.img_paths = img_paths
+        self.transform = transform
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        return self.transform(Image.open(self.img_paths[idx]).convert('RGB'))
+
+
+def extract_features(dataset, model, out, batch_size=64, num_workers=4, prefetch_factor=2, on_progress=None):
+    """Streams `dataset` through `model` and writes the outputs into the preallocated `out`.
+
+    Images are decoded by `num_workers` DataLoader workers with at most `prefetch_factor` batches queued per
+    worker, so peak memory depends on the batch size rather than on the size of the dataset. If the dataset
+    yields tuples, the image is expected as their first element. `on_progress` is called with the number of
+    rows written so far after every batch.
+    """
+    device = next(model.parameters()).device
+    loader_kwargs = dict(prefetch_factor=prefetch_factor) if num_workers > 0 else {}
+    loader = DataLoader(
+        dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        pin_memory=(device.type == 'cuda'),
+        **loader_kwargs,
+    )
+    written = 0
+    with torch.inference_mode():
+        for batch in tqdm(loader):
+            if isinstance(batch, (list, tuple)):
+                batch = batch[0]
+            features = model(batch.to(device, non_blocking=True))
+            out[written:written + len(features)] = features.float().cpu().numpy()
+            written += len(features)
+            if on_progress is not None:
+                on_progress(written)
+    return out
+
+
+class FeatureCache(object):
+    """On-disk, content-addressed store of backbone features.
+
+    Every image is keyed by its path, modification time and size, and every
+    store is namespaced by the backbone name and the preprocessing pipeline,
+    so features are only recomputed for images that are new or changed.
+    Features are kept in a memory-mapped float32 array. The index only lists
+    rows whose chunk was completely written, so an interrupted extraction
+    resumes from the last finished chunk.
+    """
+
+    def __init__(self, cache_dir, backbone, preprocess, dim):
+        namespace = hashlib.sha1(f"{backbone}|{preprocess}".encode()).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, f"{backbone}_{namespace}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.dim = dim
+        self.index_path = os.path.join(self.cache_dir, 'index.json')
+        self.features_path = os.path.join(self.cache_dir, 'features.npy')
+
+        self.n_rows, self.rows = 0, {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as f:
+                index = json.load(f)
+            self.n_rows, self.rows = index['n_rows'], index['rows']
+        if os.path.exists(self.features_path):
+            self.features = np.load(self.features_path, mmap_mode='r+')
+        else:
+            self.features = None
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return hashlib.sha1(f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}".encode()).hexdigest()
+
+    def missing(self, paths):
+        """Positions in `paths` whose features are not cached yet."""
+        return [i for i, path in enumerate(paths) if self.key(path) not in self.rows]
+
+    def reserve(self, n_rows):
+        """Grows the feature array so that `n_rows` rows fit after the committed ones and returns the first."""
+        capacity = 0 if self.features is None else self.features.shape[0]
+        if self.n_rows + n_rows > capacity:
+            new_capacity = max(self.n_rows + n_rows, 2 * capacity, 1024)
+            tmp_path = self.features_path + '.tmp'
+            features = np.lib.format.open_memmap(
+                tmp_path, mode='w+', dtype=np.float32, shape=(new_capacity, self.dim)
+            )
+            if capacity:
+                features[:capacity] = self.features
+            features.flush()
+            del features
+            self.features = None
+            os.replace(tmp_path, self.features_path)
+            self.features = np.load(self.features_path, mmap_mode='r+')
+        return self.n_rows
+
+    def commit(self, paths, start):
+        """Marks rows `start:start + len(paths)` as holding the features of `paths`."""
+        self.features.flush()
+        for offset, path in enumerate(paths):
+            self.rows[self.key(path)] = start + offset
+        self.n_rows = max(self.n_rows, start + len(paths))
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'n_rows': self.n_rows, 'rows': self.rows}, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get(self, paths):
+        rows = np.array([self.rows[self.key(path)] for path in paths], dtype=np.int64)
+        return np.asarray(self.features[rows])
+
+
+def cached_features(
+        img_paths,
+        model,
+        preprocess,
+        cache_dir,
+        backbone,
+        dim,
+        batch_size=64,
+        num_workers=4,
+        chunk_size=1024,
+):
+    """Backbone features for every image in `img_paths`, extracting only the uncached ones.
+
+    When `cache_dir` is None nothing is stored and every image is extracted.
+    """
+    if cache_dir is None:
+        out = np.empty((len(img_paths), dim), dtype=np.float32)
+        return extract_features(
+            ImagePathDataset(img_paths, preprocess),
+            model,
+            out,
+            batch_size=batch_size,
+            num_workers=num_workers,
+        )
+
+    cache = FeatureCache(cache_dir, backbone=backbone, preprocess=preprocess, dim=dim)
+    missing = cache.missing(img_paths)
+    logging.info(f"Feature cache {cache.cache_dir}: {len(img_paths) - len(missing)} cached, "
+                 f"{len(missing)} to compute")
+    if missing:
+        missing_paths = [img_paths[i] for i in missing]
+        start = cache.reserve(len(missing_paths))
+        committed = [0]
+
+        def _commit(written):
+            # Commit in whole chunks (and the tail once everything is written) so a crash loses at most one chunk
+            while (written - committed[0] >= chunk_size) or (written == len(missing_paths) > committed[0]):
+                end = min(committed[0] + chunk_size, written)
+                cache.commit(missing_paths[committed[0]:end], start + committed[0])
+                committed[0] = end
+
+        extract_features(
+            ImagePathDataset(missing_paths, preprocess),
+            model,
+            cache.features[start:start + len(missing_paths)],
+            batch_size=batch_size,
+            num_workers=num_workers,
+            on_progress=_commit,
+        )
+    return cache.get(img_paths)
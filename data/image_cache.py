@@ -0,0 +1,114 @@
+import os
+import json
+import shutil
+import hashlib
+import logging
+import numpy as np
+from tqdm import tqdm
+from PIL import Image
+from torch.utils.data import Dataset, DataLoader
+
+
+def _output_size(width, height, short_side=None, size=None):
+    """(width, height) of an image after the cache's resize; `size` wins over `short_side`."""
+    if size is not None:
+        return size
+    if short_side is None:
+        return width, height
+    scale = short_side / min(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class _DecodeDataset(Dataset):
+    def __init__(self, img_paths, short_side=None, size=None):
+        self.img_paths = img_paths
+        self.short_side = short_side
+        self.size = size
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __getitem__(self, idx):
+        img = Image.open(self.img_paths[idx]).convert('RGB')
+        if self.size is not None:
+            # Same call (and default resampling filter) as the datasets used when decoding on the fly
+            img = img.resize(self.size)
+        elif self.short_side is not None:
+            img = img.resize(_output_size(*img.size, short_side=self.short_side), Image.BILINEAR)
+        return idx, np.asarray(img, dtype=np.uint8)
+
+
+class ImageCache(object):
+    """
+    Decoded RGB images stored once as uint8 in a single memory-mapped array.
+
+    `pixels.npy` holds every image flattened in HWC order back to back, `offsets.npy` [N + 1] and `shapes.npy`
+    [N, 3] locate image i, which `cache[i]` returns as a read-only view of the memmap without copying. Images are
+    either kept at their native resolution, resized so that their short side is `short_side`, or resized to the
+    fixed (width, height) `size`. Each (image list, resize) pair gets its own directory under `cache_dir`, written
+    on first use and reused afterwards.
+    """
+
+    def __init__(self, img_paths, cache_dir, short_side=None, size=None, num_workers=4):
+        size = tuple(size) if size is not None else None
+        namespace = hashlib.sha1(
+            f"{short_side}|{size}|".encode() + "\n".join(os.path.abspath(p) for p in img_paths).encode()
+        ).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir, f"images_{namespace}")
+        if not os.path.exists(os.path.join(self.cache_dir, 'index.json')):
+            self._build(img_paths, short_side, size, num_workers)
+        else:
+            logging.info(f"Image cache {self.cache_dir}: reusing {len(img_paths)} decoded images")
+        self.pixels = np.load(os.path.join(self.cache_dir, 'pixels.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(self.cache_dir, 'offsets.npy'))
+        self.shapes = np.load(os.path.join(self.cache_dir, 'shapes.npy'))
+
+    def _build(self, img_paths, short_side, size, num_workers):
+        logging.info(f"Image cache {self.cache_dir}: decoding {len(img_paths)} images")
+        tmp_dir = self.cache_dir + '.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+
+        # Image headers are enough to lay out the array, so every image is decoded exactly once below
+        shapes = np.zeros((len(img_paths), 3), dtype=np.int64)
+        for i, path in enumerate(img_paths):
+            with Image.open(path) as img:
+                width, height = _output_size(*img.size, short_side=short_side, size=size)
+            shapes[i] = (height, width, 3)
+        offsets = np.concatenate([[0], np.cumsum(np.prod(shapes, axis=1))])
+        pixels = np.lib.format.open_memmap(
+            os.path.join(tmp_dir, 'pixels.npy'), mode='w+', dtype=np.uint8, shape=(int(offsets[-1]),)
+        )
+
+        loader = DataLoader(
+            _DecodeDataset(img_paths, short_side=short_side, size=size),
+            batch_size=None,
+            num_workers=num_workers,
+        )
+        for i, img in tqdm(loader, total=len(img_paths)):
+            pixels[offsets[i]:offsets[i + 1]] = np.asarray(img).reshape(-1)
+        pixels.flush()
+        del pixels
+
+        np.save(os.path.join(tmp_dir, 'offsets.npy'), offsets)
+        np.save(os.path.join(tmp_dir, 'shapes.npy'), shapes)
+        with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+            json.dump({'img_paths': list(img_paths), 'short_side': short_side, 'size': size}, f)
+        shutil.rmtree(self.cache_dir, ignore_errors=True)
+        os.replace(tmp_dir, self.cache_dir)
+
+    def __getstate__(self):
+        # Pickling a memmap copies its contents, so DataLoader workers reopen the file instead
+        state = self.__dict__.copy()
+        del state['pixels']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.pixels = np.load(os.path.join(self.cache_dir, 'pixels.npy'), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, idx):
+        return self.pixels[self.offsets[idx]:self.offsets[idx + 1]].reshape(self.shapes[idx])
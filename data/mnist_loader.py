@@ -1,3 +1,4 @@
+import copy
 import logging
 import numpy as np
 import os
@@ -8,72 +9,58 @@ import torchvision
 from pytorch_lightning import seed_everything
 from torch.utils.data import Dataset, TensorDataset, DataLoader, random_split
 
+from data.neighbors import find_neighbors
+from data.samplers import batching_options, train_batching
+from data.snapshot import snapshot_cached
+from data.utils import compute_pseudo_concepts, concept_imbalance, get_label_index, stratified_labeled_mask
 
-def get_ss_components(xs, ys, cs, labeled_ratio, training=False, seed=42):
-    from collections import defaultdict
-    from sklearn.neighbors import NearestNeighbors
 
-    def nearest_neighbors(xs, l_choice, k=3):
-        size = xs.shape[0]
-        features = xs.copy().reshape(size, -1)
-        labeled_features = []
-        for idx in range(size):
-            if l_choice[idx]:
-                labeled_features.append(features[idx])
-        labeled_features = np.array(labeled_features)
-        nbrs = NearestNeighbors(n_neighbors=k, metric='cosine')
-        nbrs.fit(labeled_features)
-        distances, indices = nbrs.kneighbors(features)
-
-        weights = 1.0 / (distances + 1e-6)
-        weights = weights / np.sum(weights, axis=1, keepdims=True)
-
-        return [{'indices': idx, 'weights': w} for idx, w in zip(indices, weights)]
-
-    l_choice = defaultdict(bool)
+def get_ss_components(features, ys, labeled_ratio, training=False, seed=42, knn_backend='exact', knn_params=None):
+    """
+    Labeled mask [N], int32 neighbour indices [N, k] (positions among the labeled samples) and float32 neighbour
+    weights [N, k] of a split. Neighbours are searched among the labeled samples on `features`, either an array of
+    samples or a lazy provider of them (see `AdditionSamples`). When every sample is labeled, no search is run and
+    each sample is its own single neighbour, so the pseudo-concepts are the true concepts.
+    """
     if training:
-        random.seed(seed)
-        class_count = defaultdict(int)
-        for y in ys:
-            class_count[y] += 1
-        labeled_count = defaultdict(int)
-        for idx, y in enumerate(ys):
-            class_label = y
-            if labeled_count[class_label] < labeled_ratio * class_count[class_label]:
-                l_choice[idx] = True
-                labeled_count[class_label] += 1
-            else:
-                l_choice[idx] = False
+        l_choice = stratified_labeled_mask(ys, labeled_ratio)
     else:
-        for idx in range(len(ys)):
-            l_choice[idx] = True
-
-    count = 0
-    for idx in range(len(l_choice)):
-        if l_choice[idx]:
-            count += 1
-    logging.info(f"actual labeled ratio: {count / len(l_choice)}")
-
-    nbrs = nearest_neighbors(xs, l_choice, k=2)
-
-    l_list, nbr_concepts_list, nbr_weights_list = [], [], []
-    for i in range(len(ys)):
-        l = l_choice[idx]
-        nbr_info = nbrs[idx]
-        nbr_indices = nbr_info['indices']
-        nbr_concepts = []
-        for i in nbr_indices:
-            nbr_concepts.append(cs[i])
-        nbr_concepts = np.array(nbr_concepts)
-        nbr_weights = nbr_info['weights']
-
-        l_list.append(l)
-        nbr_concepts_list.append(nbr_concepts)
-        nbr_weights_list.append(nbr_weights)
-
-    l, nbr_concepts, nbr_weights = np.array(l_list), np.array(nbr_concepts_list), np.array(nbr_weights_list)
-    return torch.tensor(xs), torch.tensor(ys).squeeze(), torch.tensor(cs), \
-           torch.tensor(l), torch.tensor(nbr_concepts), torch.tensor(nbr_weights)
+        l_choice = np.ones(len(ys), dtype=bool)
+    logging.info(f"actual labeled ratio: {np.mean(l_choice)}")
+    if np.all(l_choice):
+        return l_choice, np.arange(len(l_choice), dtype=np.int32)[:, None], np.ones((len(l_choice), 1), np.float32)
+
+    distances, nbr_indices = find_neighbors(features, l_choice, 2, backend=knn_backend, **(knn_params or {}))
+    nbr_weights = 1.0 / (distances + 1e-6)
+    nbr_weights = nbr_weights / np.sum(nbr_weights, axis=1, keepdims=True)
+    return l_choice, nbr_indices.astype(np.int32), nbr_weights.astype(np.float32)
+
+
+def sample_uncertainty(c, uncertain_width, mixing=True):
+    """
+    Draws, for every (sample, concept) of the hard concepts c [N, C], its soft value [N, C] (uniform in
+    [1 - uncertain_width, 1] for positive concepts and in [0, uncertain_width] otherwise), the weight its own image
+    keeps when mixed [N, C] and, with `mixing`, the sample it is mixed with [N, C], drawn uniformly among the samples
+    with the opposite value of that concept (-1 when there is none).
+    """
+    c = np.asarray(c)
+    positive = c == 1
+    soft = np.where(
+        positive,
+        np.random.uniform(1.0 - uncertain_width, 1.0, size=c.shape),
+        np.random.uniform(0.0, uncertain_width, size=c.shape),
+    ).astype(np.float32)
+    own_weight = np.where(positive, soft, 1 - soft).astype(np.float32)
+
+    partners = np.full(c.shape, -1, dtype=np.int64)
+    if mixing:
+        for j in range(c.shape[-1]):
+            pos_idxs, neg_idxs = np.flatnonzero(positive[:, j]), np.flatnonzero(~positive[:, j])
+            if len(neg_idxs):
+                partners[pos_idxs, j] = neg_idxs[np.random.randint(0, len(neg_idxs), size=len(pos_idxs))]
+            if len(pos_idxs):
+                partners[neg_idxs, j] = pos_idxs[np.random.randint(0, len(pos_idxs), size=len(neg_idxs))]
+    return soft, own_weight, partners
 
 
 def inject_uncertainty(
@@ -85,101 +72,125 @@ def inject_uncertainty(
         mixing=True,
         threshold=False,
 ):
+    """
+    Replaces the hard concepts of every (x, y, c, ...) loader in `datasets` by soft values and, with `mixing`, blends
+    the channel `j // num_operands` of every sample, for every concept j, with the same channel of a sample that has
+    the opposite value of concept j, weighted by the soft value. Mixing partners are drawn from the whole split and
+    contribute their original (unmixed) images. Virtual datasets stay virtual: the blend is applied when batches are
+    composed.
+    """
     seed_everything(42)
     results = []
-    concept_groups = concept_groups or []
-    for ds in datasets:
-        xs = []
-        ys = []
-        cs = []
-
-        for x, y, c in ds:
-            ys.append(y)
-            c_new = c.numpy()
-            x_new = x.numpy()
-            if uncertain_width:
-                for j in range(c_new.shape[-1]):
-                    num_operands = x.shape[1] if x.shape[1] > 2 else 1
-                    if mixing:
-                        possible_options_pos = x[
-                                               c[:, j] == 1,
-                                               j // num_operands,
-                                               :,
-                                               :,
-                                               ]
-                        possible_options_neg = x[
-                                               c[:, j] == 0,
-                                               j // num_operands,
-                                               :,
-                                               :,
-                                               ]
-                    for i in range(c_new.shape[0]):
-                        if c_new[i, j] == 1:
-                            c_new[i, j] = np.random.uniform(
-                                low=1.0 - uncertain_width,
-                                high=1,
-                            )
-                            if mixing:
-                                selected_mix = np.random.randint(
-                                    0,
-                                    possible_options_neg.shape[0],
-                                )
-                                x_new[i, j // num_operands, :, :] = (
-                                        x_new[i, j // num_operands, :, :] * c_new[i, j] +
-                                        (
-                                                (1 - c_new[i, j]) *
-                                                possible_options_neg[
-                                                selected_mix,
-                                                :,
-                                                :,
-                                                ].numpy()
-                                        )
-                                )
-                        else:
-                            c_new[i, j] = np.random.uniform(
-                                low=0.0,
-                                high=uncertain_width,
-                            )
-                            if mixing:
-                                selected_mix = np.random.randint(
-                                    0,
-                                    possible_options_pos.shape[0],
-                                )
-                                x_new[i, j // num_operands, :, :] = (
-                                        x_new[i, j // num_operands, :, :] * (1 - c_new[i, j]) +
-                                        c_new[i, j] * possible_options_pos[selected_mix, :, :].numpy()
-                                )
-                        if threshold:
-                            c_new[i, j] = int(c_new[i, j] >= 0.5)
-
-            xs.append(x_new)
-            cs.append(c_new)
-        x = torch.FloatTensor(np.concatenate(xs, axis=0))
-
-        y = torch.cat(ys, dim=0)
-        c = torch.FloatTensor(np.concatenate(cs, axis=0))
-        results.append(DataLoader(TensorDataset(x, y, c), batch_size=batch_size, num_workers=num_workers))
+    for dl in datasets:
+        ds = dl.dataset
+        x, y, c, *others = (ds.samples,) + ds.tensors if isinstance(ds, VirtualAdditionDataset) else ds.tensors
+        if isinstance(x, AdditionSamples) and not x.supports_mixing():
+            x = torch.from_numpy(x[:])
+        num_operands = x.shape[1] if x.shape[1] > 2 else 1
+        channels = np.arange(c.shape[-1]) // num_operands
+
+        soft, own_weight, partners = sample_uncertainty(c.numpy(), uncertain_width, mixing=mixing)
+        c_new = torch.from_numpy((soft >= 0.5).astype(np.float32) if threshold else soft)
+        if isinstance(x, AdditionSamples):
+            ds = VirtualAdditionDataset(x.with_mixing(channels, own_weight, partners), y, c_new, *others)
+        else:
+            x_clean = x.numpy()
+            x_new = x_clean.copy()
+            for j, channel in enumerate(channels):
+                mixed = np.flatnonzero(partners[:, j] >= 0)
+                weight = own_weight[mixed, j, None, None]
+                x_new[mixed, channel] = (
+                        weight * x_new[mixed, channel] + (1 - weight) * x_clean[partners[mixed, j], channel]
+                )
+            ds = TensorDataset(torch.from_numpy(x_new), y, c_new, *others)
+        results.append(DataLoader(ds, batch_size=batch_size, num_workers=num_workers))
     return results
 
 
-def produce_addition_set(
-        X,
+def _operand_pools(y, selected_digits):
+    """For every operand, the positions in `y` of the base images whose digit it is allowed to take."""
+    return [np.flatnonzero(np.isin(y, allowed_digits)) for allowed_digits in selected_digits]
+
+
+def sample_addition_indices(y, dataset_size, selected_digits):
+    """
+    Draws the [dataset_size, num_operands] table of base-image positions that make up every addition sample.
+
+    Operand j of sample i is drawn uniformly among the images whose digit is in `selected_digits[j]`, in one
+    `np.random.randint` call whose draws follow the same sequence as calling `np.random.choice` per sample and per
+    operand, so a given seed yields the same samples.
+    """
+    pools = _operand_pools(y, selected_digits)
+    pool_sizes = np.array([len(pool) for pool in pools])
+    draws = np.random.randint(0, np.broadcast_to(pool_sizes, (dataset_size, len(pools))))
+    return np.stack([pool[draws[:, j]] for j, pool in enumerate(pools)], axis=1)
+
+
+def addition_concepts_and_labels(
+        digits,
+        selected_digits,
+        even_concepts=False,
+        even_labels=False,
+        threshold_labels=None,
+):
+    """
+    Concepts [N, n_concepts] and task labels [N] of addition samples whose operands show `digits` [N, num_operands].
+
+    An operand with more than two allowed digits contributes a one-hot concept over them (or the parity of its
+    position among them with `even_concepts`); otherwise it contributes one binary concept, whether it shows its
+    largest allowed digit (or whether the digit is even with `even_concepts`).
+    """
+    concepts = []
+    for j, operand_digits in enumerate(selected_digits):
+        operand_digits = np.asarray(operand_digits)
+        if len(operand_digits) > 2:
+            remap = np.zeros(operand_digits.max() + 1, dtype=np.int64)
+            remap[operand_digits] = np.arange(len(operand_digits))
+            positions = remap[digits[:, j]]
+            if even_concepts:
+                concepts.append(((positions % 2) == 0).astype(np.int64)[:, None])
+            else:
+                concepts.append(np.eye(len(operand_digits), dtype=np.int64)[positions])
+        elif even_concepts:
+            concepts.append(((digits[:, j] % 2) == 0).astype(np.int64)[:, None])
+        else:
+            concepts.append((digits[:, j] == operand_digits.max()).astype(np.int64)[:, None])
+    concepts = np.concatenate(concepts, axis=-1)
+
+    labels = np.sum(digits, axis=1)
+    if even_labels:
+        labels = (labels % 2 == 0).astype(np.int64)
+    elif threshold_labels is not None:
+        labels = (labels >= threshold_labels).astype(np.int64)
+    return concepts, labels
+
+
+def compose_addition_samples(X, idxs, concat_dim='channels'):
+    """
+    Concatenates the base images X [n, H, W, C] selected by `idxs` [N, num_operands] into [N, ...] samples, along
+    the channels, the width ('x') or the height (anything else), in operand order.
+    """
+    imgs = X[idxs]  # [N, num_operands, H, W, C]
+    n, num_operands, height, width, channels = imgs.shape
+    if concat_dim == 'channels':
+        return np.moveaxis(imgs, 1, 3).reshape(n, height, width, num_operands * channels)
+    elif concat_dim == 'x':
+        return np.moveaxis(imgs, 1, 2).reshape(n, height, num_operands * width, channels)
+    return imgs.reshape(n, num_operands * height, width, channels)
+
+
+def _addition_table(
         y,
         dataset_size=30000,
         num_operands=2,
         selected_digits=list(range(10)),
-        output_channels=1,
-        img_format='channels_first',
         sample_concepts=None,
-        normalize_samples=True,
-        concat_dim='channels',
         even_concepts=False,
         even_labels=False,
         threshold_labels=None,
         concept_transform=None,
-        noise_level=0.0,
 ):
-    filter_idxs = []
+    """Base-image table [N, num_operands], task labels [N] and concepts [N, n_concepts] of an addition set."""
     if len(y.shape) == 2 and y.shape[-1] == 1:
         y = y[:, 0]
     if not isinstance(selected_digits[0], list):
@@ -190,91 +201,70 @@ def produce_addition_set(
             "length as num_operands"
         )
 
-    operand_remaps = [
-        dict((dig, idx) for (idx, dig) in enumerate(operand_digits))
-        for operand_digits in selected_digits
-    ]
-    total_operand_samples = []
-    total_operand_labels = []
-    for allowed_digits in selected_digits:
-        filter_idxs = []
-        for idx, digit in enumerate(y):
-            if digit in allowed_digits:
-                filter_idxs.append(idx)
-        total_operand_samples.append(X[filter_idxs, :, :, :])
-        total_operand_labels.append(y[filter_idxs])
-
-    sum_train_samples = []
-    sum_train_concepts = []
-    sum_train_labels = []
-    for i in range(dataset_size):
-        operands = []
-        concepts = []
-        sample_label = 0
-        selected = []
-        for operand_digits, remap, total_samples, total_labels in zip(
-                selected_digits,
-                operand_remaps,
-                total_operand_samples,
-                total_operand_labels,
-        ):
-            img_idx = np.random.choice(total_samples.shape[0])
-            selected.append(total_labels[img_idx])
-            img = total_samples[img_idx: img_idx + 1, :, :, :].copy()
-            if len(operand_digits) > 2:
-                if even_concepts:
-                    concept_vals = np.array([[
-                        int((remap[total_labels[img_idx]] % 2) == 0)
-                    ]])
-                else:
-                    concept_vals = torch.nn.functional.one_hot(
-                        torch.LongTensor([remap[total_labels[img_idx]]]),
-                        num_classes=len(operand_digits)
-                    ).numpy()
-                concepts.append(concept_vals)
-            else:
-                # Else we will treat it as a simple binary concept (this allows
-                # us to train models that do not have mutually exclusive
-                # concepts!)
-                if even_concepts:
-                    concepts.append(np.array([[
-                        int((total_labels[img_idx] % 2) == 0)
-                    ]]))
-                else:
-                    max_bound = np.max(operand_digits)
-                    val = int(total_labels[img_idx] == max_bound)
-                    concepts.append(np.array([[val]]))
-            sample_label += total_labels[img_idx]
-            operands.append(img)
-        if concat_dim == 'channels':
-            sum_train_samples.append(np.concatenate(operands, axis=3))
-        elif concat_dim == 'x':
-            sum_train_samples.append(np.concatenate(operands, axis=2))
-        else:
-            sum_train_samples.append(np.concatenate(operands, axis=1))
-        if even_labels:
-            sum_train_labels.append(int(sample_label % 2 == 0))
-        elif threshold_labels is not None:
-            sum_train_labels.append(int(sample_label >= threshold_labels))
-        else:
-            sum_train_labels.append(sample_label)
-        sum_train_concepts.append(np.concatenate(concepts, axis=-1))
-    sum_train_samples = np.concatenate(sum_train_samples, axis=0)
-    sum_train_concepts = np.concatenate(sum_train_concepts, axis=0)
-    sum_train_labels = np.array(sum_train_labels)
+    idxs = sample_addition_indices(y, dataset_size, selected_digits)
+    concepts, labels = addition_concepts_and_labels(
+        y[idxs],
+        selected_digits,
+        even_concepts=even_concepts,
+        even_labels=even_labels,
+        threshold_labels=threshold_labels,
+    )
+    if sample_concepts is not None:
+        concepts = concepts[:, sample_concepts]
+    if concept_transform is not None:
+        concepts = concept_transform(concepts)
+    return idxs, labels, concepts
+
+
+def _format_addition_samples(samples, output_channels=1, img_format='channels_first', normalize_samples=True,
+                             concat_dim='channels'):
     if output_channels != 1 and concat_dim != 'channels':
-        sum_train_samples = np.stack(
-            (sum_train_samples[:, :, :, 0].astype(np.float32),) * output_channels,
+        samples = np.stack(
+            (samples[:, :, :, 0].astype(np.float32),) * output_channels,
             axis=-1,
         )
     if img_format == 'channels_first':
-        sum_train_samples = np.transpose(sum_train_samples, axes=[0, 3, 2, 1])
+        samples = np.transpose(samples, axes=[0, 3, 2, 1])
     if normalize_samples:
-        sum_train_samples = sum_train_samples / 255.0
-    if sample_concepts is not None:
-        sum_train_concepts = sum_train_concepts[:, sample_concepts]
-    if concept_transform is not None:
-        sum_train_concepts = concept_transform(sum_train_concepts)
+        samples = samples / 255.0
+    return samples
+
+
+def produce_addition_set(
+        X,
+        y,
+        dataset_size=30000,
+        num_operands=2,
+        selected_digits=list(range(10)),
+        output_channels=1,
+        img_format='channels_first',
+        sample_concepts=None,
+        normalize_samples=True,
+        concat_dim='channels',
+        even_concepts=False,
+        even_labels=False,
+        threshold_labels=None,
+        concept_transform=None,
+        noise_level=0.0,
+):
+    idxs, sum_train_labels, sum_train_concepts = _addition_table(
+        y,
+        dataset_size=dataset_size,
+        num_operands=num_operands,
+        selected_digits=selected_digits,
+        sample_concepts=sample_concepts,
+        even_concepts=even_concepts,
+        even_labels=even_labels,
+        threshold_labels=threshold_labels,
+        concept_transform=concept_transform,
+    )
+    sum_train_samples = _format_addition_samples(
+        compose_addition_samples(X, idxs, concat_dim=concat_dim),
+        output_channels=output_channels,
+        img_format=img_format,
+        normalize_samples=normalize_samples,
+        concat_dim=concat_dim,
+    )
     if noise_level > 0.0:
         sum_train_samples = sum_train_samples + np.random.normal(
             loc=0.0,
@@ -290,6 +280,190 @@ def produce_addition_set(
     return sum_train_samples, sum_train_labels, sum_train_concepts
 
 
+class AdditionSamples(object):
+    """
+    Lazy [N, ...] float32 array of MNIST-addition samples. Only the uint8 base images X [n, H, W, 1] and the
+    [N, num_operands] table of base-image positions are stored; indexing composes the selected samples exactly as
+    `produce_addition_set` would, except that the noise of sample i is drawn from its own generator seeded with
+    (noise_seed, i), so it does not depend on which other samples are composed with it.
+
+    Channel-concatenated, channels-first samples can also carry the per-concept channel mixing of
+    `inject_uncertainty` (see `with_mixing`), which blends in the partner's base image, without its noise.
+    """
+
+    def __init__(self, X, idxs, output_channels=1, img_format='channels_first', normalize_samples=True,
+                 concat_dim='channels', noise_level=0.0, noise_seed=0):
+        self.X = X
+        self.idxs = idxs.astype(np.int32)
+        self.output_channels = output_channels
+        self.img_format = img_format
+        self.normalize_samples = normalize_samples
+        self.concat_dim = concat_dim
+        self.noise_level = noise_level
+        self.noise_seed = noise_seed
+        self.mix_channels, self.mix_weights, self.mix_images = None, None, None
+
+    def __len__(self):
+        return len(self.idxs)
+
+    @property
+    def shape(self):
+        return (len(self),) + self[0:1].shape[1:]
+
+    def supports_mixing(self):
+        # Channel c of a sample is then exactly the base image of operand c
+        return self.concat_dim == 'channels' and self.img_format == 'channels_first'
+
+    def with_mixing(self, channels, own_weights, partners):
+        """
+        Copy whose sample i has, for every concept j, its channel channels[j] blended with the same channel of
+        sample partners[i, j] (none if -1), keeping own_weights[i, j] of its own.
+        """
+        mixed = copy.copy(self)
+        mixed.mix_channels = np.asarray(channels)
+        mixed.mix_weights = own_weights.astype(np.float32)
+        mixed.mix_images = np.where(partners >= 0, self.idxs[np.maximum(partners, 0), mixed.mix_channels], -1)
+        return mixed
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+    def __getitem__(self, key):
+        rows = np.arange(len(self))[key]
+        if np.ndim(rows) == 0:
+            return self[rows:rows + 1][0]
+        samples = _format_addition_samples(
+            compose_addition_samples(self.X, self.idxs[rows], concat_dim=self.concat_dim).astype(np.float32),
+            output_channels=self.output_channels,
+            img_format=self.img_format,
+            normalize_samples=self.normalize_samples,
+            concat_dim=self.concat_dim,
+        )
+        if self.noise_level > 0.0:
+            samples += np.stack([
+                np.random.default_rng([self.noise_seed, row]).normal(0.0, self.noise_level, samples.shape[1:])
+                for row in rows
+            ]).astype(np.float32)
+            if self.normalize_samples:
+                np.clip(samples, 0.0, 1.0, out=samples)
+        if self.mix_images is not None:
+            for j, channel in enumerate(self.mix_channels):
+                in_batch = self.mix_images[rows, j] >= 0
+                mixed = rows[in_batch]
+                partner = self.X[self.mix_images[mixed, j], :, :, 0].transpose(0, 2, 1).astype(np.float32)
+                if self.normalize_samples:
+                    partner /= 255.0
+                weight = self.mix_weights[mixed, j, None, None]
+                samples[in_batch, channel] = weight * samples[in_batch, channel] + (1 - weight) * partner
+        return samples
+
+
+class VirtualAdditionDataset(Dataset):
+    """
+    `TensorDataset` counterpart whose first field is composed on demand from an `AdditionSamples`. Batches are
+    composed at once through `__getitems__`.
+    """
+
+    def __init__(self, samples, *tensors):
+        assert all(len(samples) == len(tensor) for tensor in tensors), "Size mismatch between fields"
+        self.samples = samples
+        self.tensors = tensors
+
+    def __len__(self):
+        return len(self.samples)
+
+    def label_index(self):
+        return self.tensors[0].numpy(), self.tensors[1].numpy()
+
+    def __getitems__(self, indices):
+        x = torch.from_numpy(self.samples[np.asarray(indices)])
+        return [(x[i],) + tuple(tensor[idx] for tensor in self.tensors) for i, idx in enumerate(indices)]
+
+    def __getitem__(self, idx):
+        return self.__getitems__([idx])[0]
+
+
+def build_addition_dataset(
+        X,
+        y,
+        labeled_ratio,
+        training=False,
+        virtual_dataset=True,
+        knn_backend='exact',
+        knn_params=None,
+        output_channels=1,
+        img_format='channels_first',
+        concat_dim='channels',
+        noise_level=0.0,
+        snapshot=None,
+        snapshot_entry=None,
+        **table_kwargs
+):
+    """
+    Semi-supervised MNIST-addition split drawn from the base images X, returned as a dataset of
+    (x, y, c, l, c_pseudo) samples. With `virtual_dataset` the samples are never materialised: the
+    dataset keeps X and the index table and composes every batch when it is loaded.
+    """
+    def prepare():
+        if not virtual_dataset:
+            x, labels, concepts = produce_addition_set(
+                X=X,
+                y=y,
+                output_channels=output_channels,
+                img_format=img_format,
+                concat_dim=concat_dim,
+                noise_level=noise_level,
+                **table_kwargs
+            )
+            x = x.astype(np.float32)
+            prepared = {'x': x}
+        else:
+            idxs, labels, concepts = _addition_table(y, **table_kwargs)
+            # Only split-level seeds come from the global RNG, per-sample noise is derived from them
+            noise_seed = np.random.randint(0, 2 ** 31 - 1) if noise_level > 0.0 else 0
+            x = AdditionSamples(
+                X,
+                idxs,
+                output_channels=output_channels,
+                img_format=img_format,
+                concat_dim=concat_dim,
+                noise_level=noise_level,
+                noise_seed=noise_seed,
+            )
+            prepared = {'idxs': idxs, 'noise_seed': int(noise_seed)}
+        if table_kwargs.get('even_labels', False) or (table_kwargs.get('threshold_labels') is not None):
+            labels = labels.astype(np.float32)
+        else:
+            labels = labels.astype(np.int64)
+        concepts = concepts.astype(np.float32)
+
+        l_choice, nbr_indices, nbr_weights = get_ss_components(
+            x, labels, labeled_ratio, training=training, knn_backend=knn_backend, knn_params=knn_params
+        )
+        c_pseudo = compute_pseudo_concepts(concepts, np.flatnonzero(l_choice), nbr_indices, nbr_weights)
+        prepared.update(labels=labels, concepts=concepts, l_choice=l_choice, c_pseudo=c_pseudo)
+        return prepared
+
+    prepared = snapshot_cached(snapshot, snapshot_entry, prepare)
+    # Arrays restored from a snapshot are read-only memmaps, tensors get writable in-memory copies
+    tensors = tuple(
+        torch.from_numpy(np.require(prepared[name], requirements='W'))
+        for name in ('labels', 'concepts', 'l_choice', 'c_pseudo')
+    )
+    if virtual_dataset:
+        x = AdditionSamples(
+            X,
+            prepared['idxs'],
+            output_channels=output_channels,
+            img_format=img_format,
+            concat_dim=concat_dim,
+            noise_level=noise_level,
+            noise_seed=prepared['noise_seed'],
+        )
+        return VirtualAdditionDataset(x, *tensors)
+    return TensorDataset(torch.from_numpy(np.require(prepared['x'], requirements='W')), *tensors)
+
+
 def load_mnist_addition(
         cache_dir="data",
         labeled_ratio=0.2,
@@ -316,6 +490,11 @@ def load_mnist_addition(
         concept_transform=None,
         noise_level=0.0,
         test_noise_level=None,
+        knn_backend='exact',
+        knn_params=None,
+        virtual_dataset=True,
+        batching=None,
+        snapshot=None,
 ):
     test_noise_level = (
         test_noise_level if (test_noise_level is not None) else noise_level
@@ -356,9 +535,13 @@ def load_mnist_addition(
     y_test = np.concatenate(y_test, axis=0)
 
     # Wrap them up in dataloaders
-    x_test, y_test, c_test = produce_addition_set(
+    test_data = build_addition_dataset(
         X=x_test,
         y=y_test,
+        labeled_ratio=1.,
+        virtual_dataset=virtual_dataset,
+        knn_backend=knn_backend,
+        knn_params=knn_params,
         dataset_size=test_dataset_size,
         num_operands=num_operands,
         selected_digits=selected_digits,
@@ -371,17 +554,9 @@ def load_mnist_addition(
         threshold_labels=threshold_labels,
         concept_transform=concept_transform,
         noise_level=test_noise_level,
+        snapshot=snapshot,
+        snapshot_entry='test',
     )
-    x_test = torch.FloatTensor(x_test)
-    if even_labels or (threshold_labels is not None):
-        y_test = torch.FloatTensor(y_test)
-    else:
-        y_test = torch.LongTensor(y_test)
-    c_test = torch.FloatTensor(c_test)
-    x_test, y_test, c_test, l_test, ncs_test, nws_test = get_ss_components(
-        x_test.numpy(), y_test.numpy(), c_test.numpy(), labeled_ratio=1.
-    )
-    test_data = torch.utils.data.TensorDataset(x_test, y_test, c_test, l_test, ncs_test, nws_test)
     test_dl = DataLoader(test_data, batch_size=batch_size, num_workers=num_workers)
     if uncertain_width and (not even_concepts):
         [test_dl] = inject_uncertainty(
@@ -420,15 +595,20 @@ def load_mnist_addition(
     y_train = np.concatenate(y_train, axis=0)
 
     if val_percent:
-        x_train, x_val, y_train, y_val = \
-            sklearn.model_selection.train_test_split(
-                x_train,
-                y_train,
-                test_size=val_percent,
-            )
-        x_val, y_val, c_val = produce_addition_set(
+        # Same draws as splitting the arrays themselves, but only the indices have to be kept in a snapshot
+        val_split = snapshot_cached(snapshot, 'val_split', lambda: dict(zip(
+            ('train_idxs', 'val_idxs'),
+            sklearn.model_selection.train_test_split(np.arange(len(x_train)), test_size=val_percent),
+        )))
+        x_train, x_val = x_train[val_split['train_idxs']], x_train[val_split['val_idxs']]
+        y_train, y_val = y_train[val_split['train_idxs']], y_train[val_split['val_idxs']]
+        val_data = build_addition_dataset(
             X=x_val,
             y=y_val,
+            labeled_ratio=1.,
+            virtual_dataset=virtual_dataset,
+            knn_backend=knn_backend,
+            knn_params=knn_params,
             dataset_size=int(train_dataset_size * val_percent),
             num_operands=num_operands,
             selected_digits=selected_digits,
@@ -441,16 +621,9 @@ def load_mnist_addition(
             threshold_labels=threshold_labels,
             concept_transform=concept_transform,
             noise_level=noise_level,
+            snapshot=snapshot,
+            snapshot_entry='val',
         )
-        x_val = torch.FloatTensor(x_val)
-        if even_labels or (threshold_labels is not None):
-            y_val = torch.FloatTensor(y_val)
-        else:
-            y_val = torch.LongTensor(y_val)
-        c_val = torch.FloatTensor(c_val)
-        x_val, y_val, c_val, l_val, ncs_val, nws_val = get_ss_components(
-            x_val.numpy(), y_val.numpy(), c_val.numpy(), labeled_ratio=1.)
-        val_data = torch.utils.data.TensorDataset(x_val, y_val, c_val, l_val, ncs_val, nws_val)
         val_dl = DataLoader(val_data, batch_size=batch_size, num_workers=num_workers)
         if uncertain_width and (not even_concepts):
             [val_dl] = inject_uncertainty(
@@ -465,9 +638,14 @@ def load_mnist_addition(
     else:
         val_dl = None
 
-    x_train, y_train, c_train = produce_addition_set(
+    train_data = build_addition_dataset(
         X=x_train,
         y=y_train,
+        labeled_ratio=labeled_ratio,
+        training=True,
+        virtual_dataset=virtual_dataset,
+        knn_backend=knn_backend,
+        knn_params=knn_params,
         dataset_size=train_dataset_size,
         num_operands=num_operands,
         selected_digits=selected_digits,
@@ -480,16 +658,9 @@ def load_mnist_addition(
         threshold_labels=threshold_labels,
         concept_transform=concept_transform,
         noise_level=noise_level,
+        snapshot=snapshot,
+        snapshot_entry='train',
     )
-    x_train = torch.FloatTensor(x_train)
-    if even_labels or (threshold_labels is not None):
-        y_train = torch.FloatTensor(y_train)
-    else:
-        y_train = torch.LongTensor(y_train)
-    c_train = torch.FloatTensor(c_train)
-    x_train, y_train, c_train, l_train, ncs_train, nws_train = get_ss_components(
-        x_train.numpy(), y_train.numpy(), c_train.numpy(), labeled_ratio=labeled_ratio, training=True)
-    train_data = torch.utils.data.TensorDataset(x_train, y_train, c_train, l_train, ncs_train, nws_train)
     train_dl = DataLoader(train_data, batch_size=batch_size, num_workers=num_workers)
 
     if uncertain_width and (not even_concepts):
@@ -502,6 +673,14 @@ def load_mnist_addition(
             mixing=mixing,
             threshold=threshold,
         )
+    if batching is not None:
+        # The labeled mask of the (x, y, c, l, c_pseudo) samples is the second to last stored tensor, for both
+        # materialised and virtual datasets
+        train_dl = DataLoader(
+            train_dl.dataset,
+            num_workers=num_workers,
+            **train_batching(train_dl.dataset.tensors[-2].numpy(), batch_size, seed=seed, **batching),
+        )
 
     return train_dl, val_dl, test_dl
 
@@ -511,7 +690,8 @@ def generate_data(
         root_dir="data",
         labeled_ratio=0.1,
         seed=42,
-        rerun=False
+        rerun=False,
+        snapshot=None,
 ):
     selected_digits = config.get("selected_digits", list(range(2)))
     num_operands = config.get("num_operands", 32)
@@ -635,18 +815,18 @@ def generate_data(
         even_concepts=even_concepts,
         concept_transform=concept_transform,
         noise_level=config.get("noise_level", 0),
-        test_noise_level=config.get("test_noise_level", config.get("noise_level", 0))
+        test_noise_level=config.get("test_noise_level", config.get("noise_level", 0)),
+        knn_backend=config.get("knn_backend", "exact"),
+        knn_params=config.get("knn_params"),
+        virtual_dataset=config.get("virtual_dataset", True),
+        batching=batching_options(config),
+        snapshot=snapshot,
     )
 
     if config.get('weight_loss', False):
-        attribute_count = np.zeros((num_concepts,))
-        samples_seen = 0
-        for i, data in enumerate(train_dl):
-            _, y, c, _, _, _ = data
-            c = c.cpu().detach().numpy()
-            attribute_count += np.sum(c, axis=0)
-            samples_seen += c.shape[0]
-        imbalance = samples_seen / attribute_count - 1
+        imbalance = snapshot_cached(
+            snapshot, 'imbalance', lambda: {'imbalance': concept_imbalance(get_label_index(train_dl.dataset)[1])}
+        )['imbalance']
     else:
         imbalance = None
 
@@ -0,0 +1,282 @@
+import time
+import logging
+import numpy as np
+
+
+def l2_normalize(features):
+    """Row-wise L2 normalisation in float32 of the flattened rows; all-zero rows are left at zero (as sklearn does)."""
+    features = np.asarray(features, dtype=np.float32).reshape(len(features), -1)
+    norms = np.linalg.norm(features, axis=1, keepdims=True)
+    return features / np.where(norms > 0, norms, 1)
+
+
+def search_in_blocks(search, queries, k, block_size):
+    """
+    Runs `search(block, k)` over the L2-normalised queries, `block_size` rows at a time, and gathers the [N, k]
+    distances and neighbour positions. Queries are only read one block at a time, so they can be any lazy provider
+    of feature rows supporting `len()` and slicing, which is never materialised whole.
+    """
+    distances = np.empty((len(queries), k), dtype=np.float32)
+    indices = np.empty((len(queries), k), dtype=np.int64)
+    for start in range(0, len(queries), block_size):
+        block_distances, block_indices = search(l2_normalize(queries[start:start + block_size]), k)
+        distances[start:start + len(block_distances)] = block_distances
+        indices[start:start + len(block_indices)] = block_indices
+    return distances, indices
+
+
+class NeighborIndex(object):
+    """
+    Cosine nearest-neighbour index over the labeled samples of a split.
+
+    `fit` receives the [L, d] labeled features and `kneighbors` returns, for every query, the cosine distances and
+    the positions (within the fitted features) of its `k` nearest neighbours, both [N, k] and sorted by distance,
+    like `sklearn.neighbors.NearestNeighbors.kneighbors`. Rows with more than one dimension are flattened.
+    Queries are read in row blocks, see `search_in_blocks`.
+    """
+
+    def fit(self, features):
+        raise NotImplementedError
+
+    def kneighbors(self, queries, k):
+        raise NotImplementedError
+
+
+class SklearnNeighborIndex(NeighborIndex):
+    """Brute-force search through sklearn."""
+
+    def __init__(self, query_block=8192):
+        self.query_block = query_block
+
+    def fit(self, features):
+        from sklearn.neighbors import NearestNeighbors
+
+        self.nbrs = NearestNeighbors(metric='cosine')
+        self.nbrs.fit(np.asarray(features).reshape(len(features), -1))
+        return self
+
+    def kneighbors(self, queries, k):
+        # Cosine distances do not depend on the norm of the queries
+        return search_in_blocks(
+            lambda block, k: self.nbrs.kneighbors(block, n_neighbors=k), queries, k, self.query_block
+        )
+
+
+class ExactNeighborIndex(NeighborIndex):
+    """
+    Brute-force search with torch matmuls. Features are L2-normalised once, and the [queries, labeled] similarity
+    matrix is computed in blocks of at most `memory_budget` bytes, one matmul per block, while a running top-k is
+    kept per query. Returns the same neighbours and distances as `SklearnNeighborIndex` up to ties.
+
+    memory_budget (int): bytes used by one block of similarities
+    num_threads (int): CPU threads used by torch, defaults to torch's own setting
+    device (str): device the matmuls run on
+    """
+
+    def __init__(self, memory_budget=2 ** 30, num_threads=None, device='cpu'):
+        self.memory_budget = memory_budget
+        self.num_threads = num_threads
+        self.device = device
+
+    def fit(self, features):
+        import torch
+
+        self.labeled = torch.from_numpy(l2_normalize(features)).to(self.device)
+        return self
+
+    def kneighbors(self, queries, k):
+        import torch
+
+        if self.num_threads is None:
+            return self._kneighbors(queries, k)
+        # The thread count is process-wide, so it is only overridden for the search
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        try:
+            return self._kneighbors(queries, k)
+        finally:
+            torch.set_num_threads(num_threads)
+
+    def _kneighbors(self, queries, k):
+        import torch
+
+        n_labeled = len(self.labeled)
+        # Split the labeled set too when even a few hundred query rows against all of it would exceed the budget
+        col_block = min(n_labeled, max(k, self.memory_budget // (4 * 256)))
+        # Both the block of similarities and the block of query features have to fit in the budget
+        row_block = max(1, self.memory_budget // (4 * max(col_block, self.labeled.shape[1])))
+
+        distances = np.empty((len(queries), k), dtype=np.float32)
+        indices = np.empty((len(queries), k), dtype=np.int64)
+        with torch.inference_mode():
+            for start in range(0, len(queries), row_block):
+                block = torch.from_numpy(l2_normalize(queries[start:start + row_block])).to(self.device)
+                best_sims, best_ids = None, None
+                for col in range(0, n_labeled, col_block):
+                    labeled = self.labeled[col:col + col_block]
+                    sims, ids = torch.topk(block @ labeled.T, min(k, len(labeled)), dim=1)
+                    ids += col
+                    if best_sims is not None:
+                        sims, top = torch.topk(torch.cat([best_sims, sims], dim=1), k, dim=1)
+                        ids = torch.gather(torch.cat([best_ids, ids], dim=1), 1, top)
+                    best_sims, best_ids = sims, ids
+                # sklearn clips cosine distances to [0, 2]
+                distances[start:start + len(block)] = torch.clamp(1 - best_sims, 0, 2).cpu().numpy()
+                indices[start:start + len(block)] = best_ids.cpu().numpy()
+        return distances, indices
+
+
+class IVFNeighborIndex(NeighborIndex):
+    """
+    Inverted-file index: the labeled features are clustered into `n_lists` lists with k-means and every query is
+    only compared with the members of the `n_probe` lists whose centroids are closest to it.
+
+    Queries whose probed lists hold fewer than `k` labeled samples in total are searched exhaustively instead, so
+    every query gets `k` valid neighbours.
+
+    n_lists (int): number of lists, defaults to sqrt(L)
+    n_probe (int): lists scanned per query; higher is slower and closer to the exact search
+    query_block (int): queries searched at once
+    """
+
+    def __init__(self, n_lists=None, n_probe=8, seed=42, query_block=8192):
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.seed = seed
+        self.query_block = query_block
+
+    def fit(self, features):
+        from sklearn.cluster import MiniBatchKMeans
+
+        features = l2_normalize(features)
+        n_lists = min(self.n_lists or max(1, int(np.sqrt(len(features)))), len(features))
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, random_state=self.seed, n_init=3)
+        assignments = kmeans.fit_predict(features)
+        self.centroids = l2_normalize(kmeans.cluster_centers_)
+
+        # Members of list j are ids[offsets[j]:offsets[j + 1]]
+        self.ids = np.argsort(assignments, kind='stable')
+        self.vectors = features[self.ids]
+        self.exact = ExactNeighborIndex().fit(features)
+        self.offsets = np.concatenate([[0], np.cumsum(np.bincount(assignments, minlength=n_lists))])
+        return self
+
+    def kneighbors(self, queries, k):
+        return search_in_blocks(self._search, queries, k, self.query_block)
+
+    def _search(self, queries, k):
+        n_lists = len(self.centroids)
+        n_probe = min(self.n_probe, n_lists)
+        probes = np.argpartition(-(queries @ self.centroids.T), n_probe - 1, axis=1)[:, :n_probe]
+
+        # Invert the probe table so every list is scanned once against all the queries that probe it
+        probe_lists = probes.reshape(-1)
+        probe_queries = np.repeat(np.arange(len(queries)), n_probe)
+        order = np.argsort(probe_lists, kind='stable')
+        probe_queries = probe_queries[order]
+        query_offsets = np.concatenate([[0], np.cumsum(np.bincount(probe_lists, minlength=n_lists))])
+
+        best_sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        best_ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for j in range(n_lists):
+            rows = probe_queries[query_offsets[j]:query_offsets[j + 1]]
+            start, end = self.offsets[j], self.offsets[j + 1]
+            if len(rows) == 0 or start == end:
+                continue
+            sims = queries[rows] @ self.vectors[start:end].T
+            cand_sims = np.concatenate([best_sims[rows], sims], axis=1)
+            cand_ids = np.concatenate([best_ids[rows], np.broadcast_to(self.ids[start:end], sims.shape)], axis=1)
+            top = np.argpartition(-cand_sims, k - 1, axis=1)[:, :k]
+            best_sims[rows] = np.take_along_axis(cand_sims, top, axis=1)
+            best_ids[rows] = np.take_along_axis(cand_ids, top, axis=1)
+
+        order = np.argsort(-best_sims, axis=1, kind='stable')
+        distances = 1 - np.take_along_axis(best_sims, order, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+
+        # Queries whose probed lists hold fewer than k members are left with missing (-1) neighbours
+        missing = np.flatnonzero(np.any(best_ids < 0, axis=1))
+        if len(missing):
+            distances[missing], best_ids[missing] = self.exact.kneighbors(queries[missing], k)
+        return distances, best_ids
+
+
+class HNSWNeighborIndex(NeighborIndex):
+    """
+    Hierarchical navigable small-world graph built with faiss (`pip install faiss-cpu`).
+
+    m (int): graph degree
+    ef_construction (int): candidate list size while building
+    ef_search (int): candidate list size while querying; higher is slower and closer to the exact search
+    query_block (int): queries searched at once
+    """
+
+    def __init__(self, m=32, ef_construction=200, ef_search=128, query_block=8192):
+        self.m = m
+        self.ef_construction = ef_construction
+        self.ef_search = ef_search
+        self.query_block = query_block
+
+    def fit(self, features):
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError("The 'hnsw' neighbor index requires faiss, install it with `pip install faiss-cpu`")
+
+        features = l2_normalize(features)
+        self.index = faiss.IndexHNSWFlat(features.shape[1], self.m, faiss.METRIC_INNER_PRODUCT)
+        self.index.hnsw.efConstruction = self.ef_construction
+        self.index.add(features)
+        return self
+
+    def kneighbors(self, queries, k):
+        self.index.hnsw.efSearch = max(self.ef_search, k)
+        return search_in_blocks(self._search, queries, k, self.query_block)
+
+    def _search(self, queries, k):
+        sims, ids = self.index.search(queries, k)
+        return 1 - sims, ids.astype(np.int64)
+
+
+NEIGHBOR_INDICES = {
+    'exact': ExactNeighborIndex,
+    'sklearn': SklearnNeighborIndex,
+    'ivf': IVFNeighborIndex,
+    'hnsw': HNSWNeighborIndex,
+}
+
+
+def build_neighbor_index(backend='exact', **params):
+    if backend not in NEIGHBOR_INDICES:
+        raise ValueError(f"Unsupported neighbor index {backend}, expected one of {list(NEIGHBOR_INDICES)}")
+    return NEIGHBOR_INDICES[backend](**params)
+
+
+def find_neighbors(features, labeled_mask, k, backend='exact', recall_sample=1000, seed=42, **params):
+    """
+    Cosine kNN of every row of `features` among the rows selected by `labeled_mask`. `features` is an array or a
+    lazy row provider indexable by slices, boolean masks and index arrays.
+
+    Returns the [N, k] distances and the [N, k] neighbour positions within the labeled rows. The build time and
+    query throughput of the index are logged; for approximate backends the recall@k against the exact search is
+    also measured on `recall_sample` random queries.
+    """
+    labeled_features = features[labeled_mask]
+
+    start = time.perf_counter()
+    index = build_neighbor_index(backend, **params).fit(labeled_features)
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    distances, indices = index.kneighbors(features, k)
+    query_time = time.perf_counter() - start
+    logging.info(f"{backend} neighbor index: built on {len(labeled_features)} samples in {build_time:.2f}s, "
+                 f"{len(features) / max(query_time, 1e-9):.0f} queries/s")
+
+    if backend not in ('exact', 'sklearn') and recall_sample:
+        sample = np.random.RandomState(seed).choice(len(features), min(recall_sample, len(features)), replace=False)
+        _, exact_indices = ExactNeighborIndex().fit(labeled_features).kneighbors(features[sample], k)
+        recall = np.mean(np.any(indices[sample][:, :, None] == exact_indices[:, None, :], axis=2))
+        logging.info(f"{backend} neighbor index: recall@{k} {recall:.4f} on {len(sample)} queries")
+
+    return distances, indices
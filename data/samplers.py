@@ -0,0 +1,148 @@
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class _PoolStream(object):
+    """Endless stream of the indices of a pool, one random permutation after another, so every index is drawn
+    once before any is drawn again. The position in the current permutation is kept across epochs."""
+
+    def __init__(self, indices, rng):
+        self.indices = np.asarray(indices, dtype=np.int64)
+        self.rng = rng
+        self.order = self.rng.permutation(self.indices)
+        self.position = 0
+
+    def take(self, n):
+        taken = []
+        while n > 0:
+            if self.position == len(self.order):
+                self.order, self.position = self.rng.permutation(self.indices), 0
+            chunk = self.order[self.position:self.position + n]
+            taken.append(chunk)
+            self.position += len(chunk)
+            n -= len(chunk)
+        return np.concatenate(taken) if taken else np.empty(0, dtype=np.int64)
+
+
+class LabeledQuotaBatchSampler(Sampler):
+    """
+    Batch sampler whose batches always hold `labeled_per_batch` labeled samples and `batch_size - labeled_per_batch`
+    unlabeled ones, shuffled together.
+
+    Both pools are drawn without replacement, the labeled one (usually much smaller) simply wrapping around to a
+    new permutation when exhausted, and that position is kept from one epoch to the next so every labeled sample
+    is seen once before any is repeated. An epoch has as many batches as a plain shuffled loader over the same
+    dataset (len(dataset) // batch_size, or rounded up without `drop_last`). When one pool is empty, the other fills
+    the whole batch.
+
+    labeled_mask (np.ndarray): [N] bool mask of the labeled samples of the dataset
+    """
+
+    def __init__(self, labeled_mask, batch_size, labeled_per_batch, drop_last=True, seed=42):
+        labeled_mask = np.asarray(labeled_mask, dtype=bool)
+        if not 0 <= labeled_per_batch <= batch_size:
+            raise ValueError(f"labeled_per_batch must be between 0 and the batch size {batch_size}, "
+                             f"got {labeled_per_batch}")
+        self.batch_size = batch_size
+        self.num_samples = len(labeled_mask)
+        self.drop_last = drop_last
+        self.rng = np.random.default_rng(seed)
+
+        labeled_idxs, unlabeled_idxs = np.flatnonzero(labeled_mask), np.flatnonzero(~labeled_mask)
+        if len(unlabeled_idxs) == 0:
+            labeled_per_batch = batch_size
+        elif len(labeled_idxs) == 0:
+            labeled_per_batch = 0
+        self.labeled_per_batch = labeled_per_batch
+        self.labeled = _PoolStream(labeled_idxs, self.rng)
+        self.unlabeled = _PoolStream(unlabeled_idxs, self.rng)
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return (self.num_samples + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        for _ in range(len(self)):
+            batch = np.concatenate([
+                self.labeled.take(self.labeled_per_batch),
+                self.unlabeled.take(self.batch_size - self.labeled_per_batch),
+            ])
+            yield self.rng.permutation(batch).tolist()
+
+
+class UnlabeledSubsetSampler(Sampler):
+    """
+    Sampler visiting, every epoch, all the labeled samples and a new random subset of the unlabeled ones, shuffled
+    together.
+
+    The fraction of the unlabeled pool visited goes linearly from `unlabeled_fraction` at the first epoch to
+    `unlabeled_fraction_final` after `ramp_epochs` epochs, and stays there (constant without a final fraction).
+
+    labeled_mask (np.ndarray): [N] bool mask of the labeled samples of the dataset
+    """
+
+    def __init__(self, labeled_mask, unlabeled_fraction, unlabeled_fraction_final=None, ramp_epochs=0, seed=42):
+        labeled_mask = np.asarray(labeled_mask, dtype=bool)
+        self.labeled_idxs, self.unlabeled_idxs = np.flatnonzero(labeled_mask), np.flatnonzero(~labeled_mask)
+        self.unlabeled_fraction = unlabeled_fraction
+        self.unlabeled_fraction_final = unlabeled_fraction_final
+        self.ramp_epochs = ramp_epochs
+        self.rng = np.random.default_rng(seed)
+        self.epoch = 0
+
+    def fraction(self, epoch):
+        if self.unlabeled_fraction_final is None:
+            return self.unlabeled_fraction
+        progress = min(1., epoch / self.ramp_epochs) if self.ramp_epochs else 1.
+        return self.unlabeled_fraction + progress * (self.unlabeled_fraction_final - self.unlabeled_fraction)
+
+    def _num_unlabeled(self, epoch):
+        return int(round(min(1., max(0., self.fraction(epoch))) * len(self.unlabeled_idxs)))
+
+    def __len__(self):
+        # Trainers read the length once, so it covers the largest epoch of the schedule; shorter epochs simply end
+        # early
+        return len(self.labeled_idxs) + max(self._num_unlabeled(0), self._num_unlabeled(self.ramp_epochs))
+
+    def __iter__(self):
+        unlabeled = self.rng.choice(self.unlabeled_idxs, self._num_unlabeled(self.epoch), replace=False)
+        self.epoch += 1
+        return iter(self.rng.permutation(np.concatenate([self.labeled_idxs, unlabeled])).tolist())
+
+
+def batching_options(config):
+    """Training sampler options of a dataset_config (see `train_batching`), or None when training batches are
+    simply shuffled."""
+    if config.get('labeled_per_batch') is None and config.get('unlabeled_fraction') is None:
+        return None
+    return {
+        'labeled_per_batch': config.get('labeled_per_batch'),
+        'unlabeled_fraction': config.get('unlabeled_fraction'),
+        'unlabeled_fraction_final': config.get('unlabeled_fraction_final'),
+        'unlabeled_ramp_epochs': config.get('unlabeled_ramp_epochs', 0),
+    }
+
+
+def train_batching(labeled_mask, batch_size, drop_last=False, seed=42, labeled_per_batch=None,
+                   unlabeled_fraction=None, unlabeled_fraction_final=None, unlabeled_ramp_epochs=0):
+    """
+    DataLoader arguments that batch a training split: a `LabeledQuotaBatchSampler` with `labeled_per_batch`, an
+    `UnlabeledSubsetSampler` with `unlabeled_fraction`, and plain shuffling otherwise.
+    """
+    if labeled_per_batch is not None and unlabeled_fraction is not None:
+        raise ValueError("labeled_per_batch and unlabeled_fraction cannot be used together")
+    if labeled_per_batch is not None:
+        return dict(batch_sampler=LabeledQuotaBatchSampler(
+            labeled_mask, batch_size, labeled_per_batch, drop_last=drop_last, seed=seed
+        ))
+    if unlabeled_fraction is not None:
+        sampler = UnlabeledSubsetSampler(
+            labeled_mask,
+            unlabeled_fraction,
+            unlabeled_fraction_final=unlabeled_fraction_final,
+            ramp_epochs=unlabeled_ramp_epochs,
+            seed=seed,
+        )
+        return dict(sampler=sampler, batch_size=batch_size, drop_last=drop_last)
+    return dict(batch_size=batch_size, shuffle=True, drop_last=drop_last)
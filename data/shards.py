@@ -0,0 +1,151 @@
+import io
+import os
+import json
+import random
+import shutil
+import tarfile
+import hashlib
+import logging
+import numpy as np
+import torch
+from tqdm import tqdm
+from PIL import Image
+from torch.utils.data import IterableDataset, get_worker_info
+
+from data.utils import get_image_paths, pseudo_concepts_to_float
+
+# Where `generate_data` reads images from: the original image files, or the sequential shards written by
+# `export_shards`
+DATA_BACKENDS = ('files', 'shards')
+
+_LABEL_FIELDS = ('class_labels', 'concepts', 'l_choice', 'c_pseudo')
+
+
+def export_shards(dataset, shard_dir, shard_size=1000):
+    """
+    Packs a semi-supervised image dataset into tar shards of `shard_size` samples and returns their directory.
+
+    `dataset` provides its image files through `get_image_paths` and its `class_labels`, `concepts`, `l_choice`
+    and `c_pseudo` arrays. Every shard holds the original (still encoded) image files of consecutive samples,
+    named after their position in the dataset; `index.json` lists the shards and `labels.npz` holds the label
+    arrays. Each (images, labels, shard size) triple gets its own directory under `shard_dir`, written on first
+    use and reused afterwards.
+    """
+    img_paths = get_image_paths(dataset)
+    labels = {name: np.asarray(getattr(dataset, name)) for name in _LABEL_FIELDS}
+    sha = hashlib.sha1(f"{shard_size}|".encode() + "\n".join(os.path.abspath(p) for p in img_paths).encode())
+    for name in _LABEL_FIELDS:
+        sha.update(np.ascontiguousarray(labels[name]).tobytes())
+    out_dir = os.path.join(shard_dir, f"shards_{sha.hexdigest()[:16]}")
+    if os.path.exists(os.path.join(out_dir, 'index.json')):
+        logging.info(f"Shards {out_dir}: reusing {len(img_paths)} samples")
+        return out_dir
+
+    logging.info(f"Shards {out_dir}: packing {len(img_paths)} samples")
+    tmp_dir = out_dir + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    shards, counts = [], []
+    for start in tqdm(range(0, len(img_paths), shard_size)):
+        name = f"shard_{len(shards):06d}.tar"
+        with tarfile.open(os.path.join(tmp_dir, name), 'w') as tar:
+            for idx in range(start, min(start + shard_size, len(img_paths))):
+                tar.add(img_paths[idx], arcname=f"{idx:09d}{os.path.splitext(img_paths[idx])[1]}")
+        shards.append(name)
+        counts.append(min(shard_size, len(img_paths) - start))
+    np.savez(os.path.join(tmp_dir, 'labels.npz'), **labels)
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump({'shards': shards, 'counts': counts, 'num_samples': len(img_paths)}, f)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    return out_dir
+
+
+class ShardedImageDataset(IterableDataset):
+    """
+    Streams the shards written by `export_shards` sequentially and yields (x, y, c, l, c_pseudo) samples, where x
+    is the decoded RGB image passed through `transform`.
+
+    Every DataLoader worker reads its own subset of the shards. With `shuffle`, the shard order is reshuffled
+    every epoch (identically in all workers, so they still read disjoint shards) and samples go through a buffer
+    of `shuffle_buffer` samples from which they are drawn at random. As for any `IterableDataset`, workers batch
+    their own samples, so with `drop_last` every worker drops its last incomplete batch.
+    """
+
+    def __init__(self, path, transform=None, shuffle=False, shuffle_buffer=1000):
+        self.path = path
+        self.transform = transform
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        with open(os.path.join(path, 'index.json'), 'r') as f:
+            index = json.load(f)
+        self.shards, self.num_samples = index['shards'], index['num_samples']
+        with np.load(os.path.join(path, 'labels.npz')) as labels:
+            for name in _LABEL_FIELDS:
+                setattr(self, name, labels[name])
+
+    def __len__(self):
+        return self.num_samples
+
+    def label_index(self):
+        return self.class_labels, self.concepts
+
+    def _sample(self, name, data):
+        idx = int(os.path.splitext(name)[0])
+        img = Image.open(io.BytesIO(data)).convert('RGB')
+        if self.transform is not None:
+            img = self.transform(img)
+        return (
+            img,
+            int(self.class_labels[idx]),
+            torch.from_numpy(self.concepts[idx].astype(np.float32)),
+            torch.tensor(self.l_choice[idx]),
+            torch.from_numpy(pseudo_concepts_to_float(self.c_pseudo[idx])),
+        )
+
+    def _stream(self, shards):
+        for shard in shards:
+            with tarfile.open(os.path.join(self.path, shard), 'r|') as tar:
+                for member in tar:
+                    if member.isfile():
+                        yield self._sample(member.name, tar.extractfile(member).read())
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        if worker_info is None:
+            worker_id, num_workers = 0, 1
+            base_seed = int(torch.empty((), dtype=torch.int64).random_().item())
+        else:
+            # Workers of one epoch share the DataLoader's base seed, their own seed is base_seed + id
+            worker_id, num_workers = worker_info.id, worker_info.num_workers
+            base_seed = worker_info.seed - worker_info.id
+
+        shards = list(self.shards)
+        if self.shuffle:
+            random.Random(base_seed).shuffle(shards)
+        samples = self._stream(shards[worker_id::num_workers])
+        if not self.shuffle or self.shuffle_buffer <= 1:
+            yield from samples
+            return
+
+        rng = random.Random(base_seed + worker_id)
+        buffer = []
+        for sample in samples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(sample)
+                continue
+            pick = rng.randrange(len(buffer))
+            yield buffer[pick]
+            buffer[pick] = sample
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def sharded_dataset(dataset, shard_dir, transform=None, shuffle=False, shard_size=1000, shuffle_buffer=1000):
+    """`ShardedImageDataset` over the shards of `dataset`, which are exported first if they do not exist yet."""
+    return ShardedImageDataset(
+        export_shards(dataset, shard_dir, shard_size=shard_size),
+        transform=transform,
+        shuffle=shuffle,
+        shuffle_buffer=shuffle_buffer,
+    )
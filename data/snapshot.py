@@ -0,0 +1,109 @@
+import os
+import glob
+import json
+import shutil
+import hashlib
+import tempfile
+import logging
+import numpy as np
+
+# dataset_config keys that do not change the prepared arrays
+_UNHASHED_CONFIG_KEYS = ('num_workers', 'batch_size', 'snapshot_dir')
+
+
+def code_version(extra_files=()):
+    """Hash of the data-preparation source code (every module of this package plus `extra_files`)."""
+    sha = hashlib.sha1()
+    data_dir = os.path.dirname(os.path.abspath(__file__))
+    for path in sorted(glob.glob(os.path.join(data_dir, '*.py'))) + sorted(extra_files):
+        sha.update(os.path.basename(path).encode())
+        with open(path, 'rb') as f:
+            sha.update(f.read())
+    return sha.hexdigest()
+
+
+class DatasetSnapshot(object):
+    """
+    On-disk snapshot of the prepared arrays of a dataset (splits, labeled masks, pseudo-concepts, class weights...).
+
+    A snapshot is identified by a hash of the dataset name, its config, the seed, the labeled ratio and the code
+    version. Every entry is a dict of NumPy arrays, saved as .npy files and restored memory-mapped, and of JSON
+    values. Entries are written as the loaders compute them, but since later entries may depend on the random state
+    left by earlier ones, they are only reused once `commit` has marked the whole snapshot complete. `rerun`
+    discards an existing snapshot and rebuilds it.
+
+    A snapshot is prepared in its own temporary directory and moved into place by `commit`, so runs preparing the
+    same snapshot concurrently never see or overwrite each other's partial entries: the first to commit wins.
+    """
+
+    def __init__(self, snapshot_dir, dataset, config, seed, labeled_ratio, rerun=False, extra_code_files=()):
+        key = {
+            'dataset': dataset,
+            'config': {k: v for k, v in config.items() if k not in _UNHASHED_CONFIG_KEYS},
+            'seed': seed,
+            'labeled_ratio': labeled_ratio,
+            'code_version': code_version(extra_code_files),
+        }
+        key = json.dumps(key, sort_keys=True, default=str)
+        self.path = os.path.join(snapshot_dir, f"{dataset}_{hashlib.sha1(key.encode()).hexdigest()[:16]}")
+        self.rerun = rerun
+        self.hit = (not rerun) and self._complete()
+        if self.hit:
+            logging.info(f"Dataset snapshot hit: restoring prepared data from {self.path}")
+            self.write_path = None
+        else:
+            logging.info(f"Dataset snapshot miss: preparing data for {self.path}")
+            os.makedirs(snapshot_dir, exist_ok=True)
+            self.write_path = tempfile.mkdtemp(prefix=f"{os.path.basename(self.path)}.tmp", dir=snapshot_dir)
+            with open(os.path.join(self.write_path, 'key.json'), 'w') as f:
+                f.write(key)
+
+    def _complete(self):
+        return os.path.exists(os.path.join(self.path, 'COMPLETE'))
+
+    def _entry_path(self, entry, name=None):
+        root = self.path if self.hit else self.write_path
+        return os.path.join(root, f"{entry}.json" if name is None else f"{entry}.{name}.npy")
+
+    def cached(self, entry, compute):
+        """The values of `entry`, restored from the snapshot or computed with `compute()` and saved."""
+        if self.hit and os.path.exists(self._entry_path(entry)):
+            with open(self._entry_path(entry), 'r') as f:
+                meta = json.load(f)
+            return {
+                name: np.load(self._entry_path(entry, name), mmap_mode='r') if value is None else value['value']
+                for name, value in meta.items()
+            }
+        values = compute()
+        meta = {}
+        for name, value in values.items():
+            if isinstance(value, np.ndarray):
+                np.save(self._entry_path(entry, name), value)
+                meta[name] = None
+            else:
+                meta[name] = {'value': value}
+        with open(self._entry_path(entry), 'w') as f:
+            json.dump(meta, f)
+        return values
+
+    def commit(self):
+        """Marks the prepared snapshot complete and moves it into place, unless another run already did."""
+        if self.hit:
+            return
+        open(os.path.join(self.write_path, 'COMPLETE'), 'w').close()
+        if os.path.exists(self.path) and (self.rerun or not self._complete()):
+            # Stale (incomplete or rebuilt) snapshot
+            shutil.rmtree(self.path, ignore_errors=True)
+        try:
+            os.replace(self.write_path, self.path)
+        except OSError:
+            # Another run committed the same snapshot first
+            logging.info(f"Dataset snapshot {self.path} was committed by another run, keeping it")
+            shutil.rmtree(self.write_path, ignore_errors=True)
+
+
+def snapshot_cached(snapshot, entry, compute):
+    """`snapshot.cached(entry, compute)`, or simply `compute()` when no snapshot is used."""
+    if snapshot is None:
+        return compute()
+    return snapshot.cached(entry, compute)
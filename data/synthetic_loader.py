@@ -3,6 +3,9 @@ import torch
 
 from pytorch_lightning import seed_everything
 
+from data.snapshot import snapshot_cached
+from data.utils import concept_imbalance
+
 
 def generate_xor_data(size):
     # sample from normal distribution
@@ -95,26 +98,39 @@ class SyntheticGenerator(object):
                 root_dir=None,
                 seed=42,
                 output_dataset_vars=False,
+                labeled_ratio=1.,
+                snapshot=None,
         ):
+            # Synthetic samples are all labeled, `labeled_ratio` is only accepted for a uniform generate_data API
             seed_everything(seed)
 
             dataset_size = config.get('dataset_size', 3000)
             batch_size = config["batch_size"]
-            x, c, y = generate_data(int(dataset_size * 0.7))
+
+            def generate_splits():
+                splits = {}
+                for split, fraction in [('train', 0.7), ('test', 0.2), ('val', 0.1)]:
+                    x, c, y = generate_data(int(dataset_size * fraction))
+                    splits.update({f'x_{split}': x.numpy(), f'c_{split}': c.numpy(), f'y_{split}': y.numpy()})
+                return splits
+
+            splits = snapshot_cached(snapshot, 'splits', generate_splits)
+            x, c, y, x_test, c_test, y_test, x_val, c_val, y_val = [
+                torch.FloatTensor(np.array(splits[f'{field}_{split}']))
+                for split in ('train', 'test', 'val') for field in ('x', 'c', 'y')
+            ]
             train_data = torch.utils.data.TensorDataset(x, y, c)
             train_dl = torch.utils.data.DataLoader(
                 train_data,
                 batch_size=batch_size,
             )
 
-            x_test, c_test, y_test = generate_data(int(dataset_size * 0.2))
             test_data = torch.utils.data.TensorDataset(x_test, y_test, c_test)
             test_dl = torch.utils.data.DataLoader(
                 test_data,
                 batch_size=batch_size,
             )
 
-            x_val, c_val, y_val = generate_data(int(dataset_size * 0.1))
             val_data = torch.utils.data.TensorDataset(x_val, y_val, c_val)
             val_dl = torch.utils.data.DataLoader(
                 val_data,
@@ -122,13 +138,9 @@ class SyntheticGenerator(object):
             )
 
             if config.get('weight_loss', False):
-                attribute_count = np.zeros((num_concepts,))
-                samples_seen = 0
-                for _, (_, y, c) in enumerate(train_dl):
-                    c = c.cpu().detach().numpy()
-                    attribute_count += np.sum(c, axis=0)
-                    samples_seen += c.shape[0]
-                imbalance = samples_seen / attribute_count - 1
+                imbalance = snapshot_cached(
+                    snapshot, 'imbalance', lambda: {'imbalance': concept_imbalance(splits['c_train'])}
+                )['imbalance']
             else:
                 imbalance = None
             if not output_dataset_vars:
@@ -0,0 +1,103 @@
+import logging
+import numpy as np
+from torch.utils.data import Subset, TensorDataset
+
+
+def compute_pseudo_concepts(concepts, labeled_idxs, nbr_indices, nbr_weights, dtype='float32'):
+    """
+    Builds the [N, n_concepts] matrix of kNN pseudo-concepts in one vectorized pass.
+
+    concepts (np.ndarray): [N, n_concepts] concept labels of the whole split
+    labeled_idxs (np.ndarray): [L] positions of the labeled samples the neighbour search was fit on
+    nbr_indices (np.ndarray): [N, k] neighbour positions within `labeled_idxs`
+    nbr_weights (np.ndarray): [N, k] neighbour weights
+    dtype (str): storage dtype, one of "float32", "float16" or "uint8" (quantised to 1/255 steps)
+    """
+    concepts = np.asarray(concepts, dtype=np.float32)
+    nbr_concepts = concepts[np.asarray(labeled_idxs)[nbr_indices]]  # [N, k, n_concepts]
+    pseudo = np.mean(nbr_concepts * np.asarray(nbr_weights, dtype=np.float32)[:, :, None], axis=1)
+    return encode_pseudo_concepts(pseudo, dtype)
+
+
+def encode_pseudo_concepts(pseudo, dtype='float32'):
+    """Storage encoding of [N, n_concepts] pseudo-concepts in [0, 1], see `compute_pseudo_concepts`."""
+    pseudo = np.asarray(pseudo, dtype=np.float32)
+    if dtype == 'uint8':
+        return np.round(pseudo * 255).astype(np.uint8)
+    return pseudo.astype(dtype)
+
+
+def pseudo_concepts_to_float(pseudo):
+    """Inverse of the storage encoding used by `compute_pseudo_concepts` for a single row."""
+    if pseudo.dtype == np.uint8:
+        return pseudo.astype(np.float32) / 255
+    return pseudo.astype(np.float32)
+
+
+def get_label_index(ds):
+    """
+    Returns the class ids [N] and concept vectors [N, n_concepts] of `ds` without decoding any image.
+
+    Datasets provide them through a `label_index()` method built from their metadata; `Subset`s (e.g. the
+    splits produced by `random_split`) are resolved recursively and `TensorDataset`s hold them as their second
+    and third tensors, as in their (x, y, c, ...) samples.
+    """
+    if isinstance(ds, Subset):
+        class_labels, concepts = get_label_index(ds.dataset)
+        indices = np.asarray(ds.indices, dtype=np.int64)
+        return class_labels[indices], concepts[indices]
+    if isinstance(ds, TensorDataset):
+        return ds.tensors[1].numpy(), ds.tensors[2].numpy()
+    if hasattr(ds, 'label_index'):
+        return ds.label_index()
+    raise ValueError(f"Dataset {type(ds).__name__} does not provide a label index")
+
+
+def concept_imbalance(concepts):
+    """Per-concept imbalance ratio (negative over positive samples) of [N, n_concepts] concept labels."""
+    concepts = np.asarray(concepts, dtype=np.float64)
+    return concepts.shape[0] / np.sum(concepts, axis=0) - 1
+
+
+def task_class_weights(class_labels, n_tasks):
+    """
+    Task loss weights of [N] labels: the imbalance ratio of every class with n_tasks > 1, and the negative over
+    positive ratio of a binary task otherwise.
+    """
+    if n_tasks > 1:
+        counts = np.bincount(np.asarray(class_labels, dtype=np.int64).reshape(-1), minlength=n_tasks)
+        counts = counts.astype(np.float64)
+    else:
+        positives = np.sum(np.asarray(class_labels, dtype=np.float64))
+        counts = np.array([len(class_labels) - positives, positives])
+    logging.info(f"Class distribution is: {counts / len(class_labels)}")
+    if n_tasks > 1:
+        return len(class_labels) / counts - 1
+    return np.array([counts[0] / counts[1]])
+
+
+def stratified_labeled_mask(class_labels, labeled_ratio):
+    """
+    Returns a boolean mask marking, for every class, its first ceil(labeled_ratio * class_size) samples (in
+    dataset order) as labeled.
+    """
+    class_labels = np.asarray(class_labels).reshape(-1)
+    order = np.argsort(class_labels, kind='stable')
+    _, starts, counts = np.unique(class_labels[order], return_index=True, return_counts=True)
+    rank_in_class = np.arange(len(order)) - np.repeat(starts, counts)
+    mask = np.zeros(len(order), dtype=bool)
+    mask[order] = rank_in_class < labeled_ratio * np.repeat(counts, counts)
+    return mask
+
+
+def get_image_paths(ds):
+    """
+    Returns the image file of every sample of `ds`, provided by its `image_paths()` method; `Subset`s are
+    resolved recursively.
+    """
+    if isinstance(ds, Subset):
+        img_paths = get_image_paths(ds.dataset)
+        return [img_paths[idx] for idx in ds.indices]
+    if hasattr(ds, 'image_paths'):
+        return ds.image_paths()
+    raise ValueError(f"Dataset {type(ds).__name__} does not provide its image paths")
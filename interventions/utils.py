@@ -408,7 +408,7 @@ def intervene_in_cbm(
         else:
             x_test, y_test, c_test = [], [], []
             for data in test_dl:
-                x, y, c, _, _, _ = data
+                x, y, c = data[:3]
                 x_type = x.type()
                 y_type = y.type()
                 c_type = c.type()
@@ -742,7 +742,7 @@ def generate_policy_training_data(
     batch_size = batch_size or train_dl.batch_size
     x_train, y_train, c_train = [], [], []
     for ds_data in train_dl:
-        x, y, c, _, _, _ = ds_data
+        x, y, c = ds_data[:3]
         x_train.append(x)
         y_train.append(y)
         c_train.append(c)
@@ -791,7 +791,7 @@ def generate_policy_training_data(
         )
         val_c_true = []
         for data in val_dl:
-            x, y, c, _, _, _ = data
+            x, y, c = data[:3]
             val_c_true.append(c)
         val_c_true = np.concatenate(val_c_true, axis=0)
         for concept_idx in range(n_concepts):
@@ -1159,7 +1159,7 @@ def test_interventions(
     else:
         x_test, y_test, c_test = [], [], []
         for ds_data in test_dl:
-            x, y, c, _, _, _ = ds_data
+            x, y, c = ds_data[:3]
             x_type = x.type()
             y_type = y.type()
             c_type = c.type()
@@ -144,25 +144,32 @@ class ConceptBottleneckModel(pl.LightningModule):
         self.use_concept_groups = use_concept_groups
 
     def _unpack_batch(self, batch):
+        l, c_pseudo = None, None
+        competencies, prev_interventions = None, None
         if len(batch) == 3:
             x, y, c = batch
-            l, nbr_c, nbr_w = None, None, None
-            competencies, prev_interventions = None, None
         elif len(batch) == 4:
             x, y, c, competencies = batch
-            l, nbr_c, nbr_w, prev_interventions = None, None, None, None
+        elif len(batch) == 5 and batch[3].dtype == torch.bool:
+            # Semi-supervised batch with precomputed pseudo-concepts
+            x, y, c, l, c_pseudo = batch
         elif len(batch) == 5:
             x, y, c, competencies, prev_interventions = batch
-            l, nbr_c, nbr_w = None, None, None
         elif len(batch) == 6:
             x, y, c, l, nbr_c, nbr_w = batch
-            competencies, prev_interventions = None, None
+            c_pseudo = self._pseudo_from_neighbors(nbr_c, nbr_w)
         elif len(batch) == 7:
             x, y, c, l, nbr_c, nbr_w, competencies = batch
-            prev_interventions = None
+            c_pseudo = self._pseudo_from_neighbors(nbr_c, nbr_w)
         else:
             x, y, c, l, nbr_c, nbr_w, competencies, prev_interventions = batch
-        return x, y, c, l, nbr_c, nbr_w, competencies, prev_interventions
+            c_pseudo = self._pseudo_from_neighbors(nbr_c, nbr_w)
+        return x, y, c, l, c_pseudo, competencies, prev_interventions
+
+    @staticmethod
+    def _pseudo_from_neighbors(nbr_c, nbr_w):
+        # Legacy batches ship the neighbours' concepts [B, k, n_concepts] and weights [B, k]
+        return torch.mean(nbr_c * nbr_w.unsqueeze(-1), dim=1).to(torch.float32)
 
     def _standardize_indices(self, intervention_idxs, batch_size):
         if isinstance(intervention_idxs, list):
@@ -307,8 +314,11 @@ class ConceptBottleneckModel(pl.LightningModule):
             prev_interventions=None,
             output_embeddings=False,
             output_latent=None,
-            output_interventions=None
+            output_interventions=None,
+            output_unlabeled=True,
     ):
+        # The concept probabilities double as the unlabeled concept predictions, so `output_unlabeled` (used by
+        # models with a separate unlabeled branch) costs nothing here
         if latent is None:
             latent = self.x2c_model(x)
         if self.sigmoidal_prob or self.bool:
@@ -438,8 +448,10 @@ class ConceptBottleneckModel(pl.LightningModule):
             batch_idx,
             intervention_idxs=None,
             dataloader_idx=0,
+            output_unlabeled=False,
     ):
-        x, y, c, l, nbr_c, nbr_w, competencies, prev_interventions = self._unpack_batch(batch)
+        # Predictions do not use the unlabeled concept predictions, their branch only runs when explicitly requested
+        x, y, c, l, _, competencies, prev_interventions = self._unpack_batch(batch)
         return self._forward(
             x,
             intervention_idxs=intervention_idxs,
@@ -449,8 +461,17 @@ class ConceptBottleneckModel(pl.LightningModule):
             train=False,
             competencies=competencies,
             prev_interventions=prev_interventions,
+            output_unlabeled=output_unlabeled,
         )
 
+    @staticmethod
+    def _masked_loss(loss_fn, pred, target, mask):
+        # Losses average over the selected rows and give NaN for an empty selection (e.g. the unlabeled rows of a
+        # fully labeled validation batch), which then contributes no loss instead
+        if not mask.any():
+            return pred.new_zeros(())
+        return loss_fn(pred[mask], target[mask])
+
     def _run_step(
             self,
             batch,
@@ -458,11 +479,10 @@ class ConceptBottleneckModel(pl.LightningModule):
             train=False,
             intervention_idxs=None,
     ):
-        x, y, c, l, nbr_c, nbr_w, competencies, prev_interventions = self._unpack_batch(batch)
-
-        nbr_w_ = nbr_w.unsqueeze(-1).repeat(1, 1, nbr_c.size(2))
-        c_pseudo = nbr_c * nbr_w_
-        c_pseudo = torch.sum(c_pseudo, dim=1) / nbr_w.size(1)
+        x, y, c, l, c_pseudo, competencies, prev_interventions = self._unpack_batch(batch)
+        if l is None:
+            # Fully supervised batches
+            l = torch.ones(x.shape[0], dtype=torch.bool, device=x.device)
 
         outputs = self._forward(
             x,
@@ -479,10 +499,10 @@ class ConceptBottleneckModel(pl.LightningModule):
         task_loss = self.loss_task(y_pred, y)
         task_loss_scalar = task_loss.detach()
 
-        concept_loss_labeled = self.loss_concept_labeled(c_sem[l], c[l])
+        concept_loss_labeled = self._masked_loss(self.loss_concept_labeled, c_sem, c, l)
         concept_loss_scalar_labeled = concept_loss_labeled.detach()
 
-        concept_loss_unlabeled = self.loss_concept_unlabeled(c_pred_unlabeled[~l], c_pseudo[~l])
+        concept_loss_unlabeled = self._masked_loss(self.loss_concept_unlabeled, c_pred_unlabeled, c_pseudo, ~l)
         # concept_loss_unlabeled = self.loss_concept_unlabeled(c_sem[~l], c_pseudo[~l])
         # concept_loss_unlabeled = self.loss_concept_unlabeled(c_sem[~l], c_pred_unlabeled[~l])
         concept_loss_scalar_unlabeled = concept_loss_unlabeled.detach()
@@ -1,13 +1,139 @@
 import torch
+import logging
 from torch import nn
 import numpy as np
 import pytorch_lightning as pl
 from torchvision.models import resnet50
+from torchvision.models.resnet import ResNet
+from torchvision.models.densenet import DenseNet
 from models.cbm import ConceptBottleneckModel
 import train.utils as utils
 from utils import visualize_and_save_heatmaps
 
 
+_EMBEDDING_ACTIVATIONS = {
+    None: torch.nn.Identity,
+    "sigmoid": torch.nn.Sigmoid,
+    "leakyrelu": torch.nn.LeakyReLU,
+    "relu": torch.nn.ReLU,
+}
+
+
+class ConceptHeads(nn.Module):
+    """
+    The concept embedding generators of a CEM, fused: every concept has its own Linear(in_features, 2 * emb_size)
+    context generator (positive and negative embedding halves) followed by `embedding_activation`, and a
+    Linear(2 * emb_size, 1) probability generator, either shared by all concepts or one per concept.
+
+    Weights are stacked over concepts, so all the contexts are computed by a single matmul and all the
+    probabilities by a single batched reduction. Returns the [B, n_concepts, 2 * emb_size] contexts and the
+    [B, n_concepts] concept probabilities.
+    """
+
+    def __init__(self, in_features, n_concepts, emb_size, embedding_activation="leakyrelu", shared_prob_gen=True):
+        super().__init__()
+        if embedding_activation not in _EMBEDDING_ACTIVATIONS:
+            raise ValueError(f"Unsupported embedding activation {embedding_activation}")
+        self.in_features = in_features
+        self.n_concepts = n_concepts
+        self.emb_size = emb_size
+        self.context_weight = nn.Parameter(torch.empty(n_concepts, 2 * emb_size, in_features))
+        self.context_bias = nn.Parameter(torch.empty(n_concepts, 2 * emb_size))
+        self.prob_weight = nn.Parameter(torch.empty(1 if shared_prob_gen else n_concepts, 2 * emb_size))
+        self.prob_bias = nn.Parameter(torch.empty(1 if shared_prob_gen else n_concepts))
+        self.activation = _EMBEDDING_ACTIVATIONS[embedding_activation]()
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Same distribution as the default initialisation of each per-concept Linear
+        for weight, bias in [(self.context_weight, self.context_bias), (self.prob_weight, self.prob_bias)]:
+            bound = 1 / np.sqrt(weight.shape[-1])
+            nn.init.uniform_(weight, -bound, bound)
+            nn.init.uniform_(bias, -bound, bound)
+
+    def forward(self, pre_c):
+        contexts = nn.functional.linear(
+            pre_c,
+            self.context_weight.reshape(-1, self.in_features),
+            self.context_bias.reshape(-1),
+        ).view(pre_c.shape[0], self.n_concepts, 2 * self.emb_size)
+        contexts = self.activation(contexts)
+        logits = torch.einsum('bne,ne->bn', contexts, self.prob_weight.expand(self.n_concepts, -1)) + self.prob_bias
+        return contexts, torch.sigmoid(logits)
+
+
+class BackboneTrunk(object):
+    """
+    Runs a concept extractor once per batch and returns both its output (the pooled features fed to the concept
+    heads) and its last spatial feature map (from which the unlabeled heatmap is built): layer4 for ResNets and the
+    final dense block (after its ReLU) for DenseNets, pooled and classified exactly as in their own `forward`.
+
+    Other extractors have no spatial map to share, so their output is used as a 1x1 feature map instead.
+    Holds a plain reference to the extractor, which stays registered (and saved) as `pre_concept_model`.
+    """
+
+    def __init__(self, backbone):
+        self.backbone = backbone
+        if isinstance(backbone, ResNet):
+            self.kind = 'resnet'
+            self.feature_dim = backbone.fc.in_features
+        elif isinstance(backbone, DenseNet):
+            self.kind = 'densenet'
+            self.feature_dim = backbone.classifier.in_features
+        else:
+            logging.warning(
+                f"No spatial feature map for a {type(backbone).__name__} concept extractor, the unlabeled heatmap "
+                f"is built from its pooled output"
+            )
+            self.kind = None
+            self.feature_dim = list(backbone.modules())[-1].out_features
+
+    def feature_map(self, x):
+        """[B, feature_dim, H, W] last spatial feature map of `x`."""
+        backbone = self.backbone
+        if self.kind == 'resnet':
+            x = backbone.maxpool(backbone.relu(backbone.bn1(backbone.conv1(x))))
+            return backbone.layer4(backbone.layer3(backbone.layer2(backbone.layer1(x))))
+        if self.kind == 'densenet':
+            return nn.functional.relu(backbone.features(x), inplace=True)
+        return backbone(x)[:, :, None, None]
+
+    def pool(self, feature_map):
+        """Output of the extractor from its last spatial feature map."""
+        backbone = self.backbone
+        if self.kind == 'resnet':
+            return backbone.fc(torch.flatten(backbone.avgpool(feature_map), 1))
+        if self.kind == 'densenet':
+            return backbone.classifier(torch.flatten(nn.functional.adaptive_avg_pool2d(feature_map, (1, 1)), 1))
+        return feature_map[:, :, 0, 0]
+
+    def __call__(self, x):
+        feature_map = self.feature_map(x)
+        return self.pool(feature_map), feature_map
+
+
+def convert_legacy_concept_heads(state_dict, prefix='', *args):
+    """
+    Converts, in place, the per-concept `concept_context_generators.{i}.0` and `concept_prob_generators.{i}`
+    Linear weights of a CEM state dict saved before the heads were fused into the stacked `concept_heads`
+    parameters. Also registered as a load_state_dict pre-hook of `ConceptEmbeddingModel`.
+    """
+    context_prefix, prob_prefix = f"{prefix}concept_context_generators.", f"{prefix}concept_prob_generators."
+    if f"{context_prefix}0.0.weight" not in state_dict:
+        return state_dict
+
+    def pop_stacked(key_prefix, suffix):
+        keys = [key for key in state_dict if key.startswith(key_prefix) and key.endswith(suffix)]
+        keys.sort(key=lambda key: int(key[len(key_prefix):].split('.')[0]))
+        return torch.stack([state_dict.pop(key) for key in keys])
+
+    state_dict[f"{prefix}concept_heads.context_weight"] = pop_stacked(context_prefix, '.0.weight')
+    state_dict[f"{prefix}concept_heads.context_bias"] = pop_stacked(context_prefix, '.0.bias')
+    state_dict[f"{prefix}concept_heads.prob_weight"] = pop_stacked(prob_prefix, '.weight')[:, 0, :]
+    state_dict[f"{prefix}concept_heads.prob_bias"] = pop_stacked(prob_prefix, '.bias')[:, 0]
+    return state_dict
+
+
 class ConceptEmbeddingModel(ConceptBottleneckModel):
     def __init__(
             self,
@@ -47,6 +173,7 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
         self.output_interventions = output_interventions
         self.intervention_policy = intervention_policy
         self.pre_concept_model = c_extractor_arch(output_dim=None)
+        self.trunk = BackboneTrunk(self.pre_concept_model)
         self.training_intervention_prob = training_intervention_prob
         self.output_latent = output_latent
         if self.training_intervention_prob != 0:
@@ -65,73 +192,17 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
         else:
             self.inactive_intervention_values = torch.ones(n_concepts)
         self.task_loss_weight = task_loss_weight
-        self.concept_context_generators = torch.nn.ModuleList()
-        self.concept_prob_generators = torch.nn.ModuleList()
         self.shared_prob_gen = shared_prob_gen
         self.top_k_accuracy = top_k_accuracy
-        for i in range(n_concepts):
-            if embedding_activation is None:
-                self.concept_context_generators.append(
-                    torch.nn.Sequential(*[
-                        torch.nn.Linear(
-                            list(
-                                self.pre_concept_model.modules()
-                            )[-1].out_features,
-                            # Two as each concept will have a positive and a
-                            # negative embedding portion which are later mixed
-                            2 * emb_size,
-                        ),
-                    ])
-                )
-            elif embedding_activation == "sigmoid":
-                self.concept_context_generators.append(
-                    torch.nn.Sequential(*[
-                        torch.nn.Linear(
-                            list(
-                                self.pre_concept_model.modules()
-                            )[-1].out_features,
-                            # Two as each concept will have a positive and a
-                            # negative embedding portion which are later mixed
-                            2 * emb_size,
-                        ),
-                        torch.nn.Sigmoid(),
-                    ])
-                )
-            elif embedding_activation == "leakyrelu":
-                self.concept_context_generators.append(
-                    torch.nn.Sequential(*[
-                        torch.nn.Linear(
-                            list(
-                                self.pre_concept_model.modules()
-                            )[-1].out_features,
-                            # Two as each concept will have a positive and a
-                            # negative embedding portion which are later mixed
-                            2 * emb_size,
-                        ),
-                        torch.nn.LeakyReLU(),
-                    ])
-                )
-            elif embedding_activation == "relu":
-                self.concept_context_generators.append(
-                    torch.nn.Sequential(*[
-                        torch.nn.Linear(
-                            list(
-                                self.pre_concept_model.modules()
-                            )[-1].out_features,
-                            # Two as each concept will have a positive and a
-                            # negative embedding portion which are later mixed
-                            2 * emb_size,
-                        ),
-                        torch.nn.ReLU(),
-                    ])
-                )
-            if self.shared_prob_gen and len(self.concept_prob_generators) == 0:
-                # Then we will use one and only one probability generator which
-                # will be shared among all concepts. This will force concept
-                # embedding vectors to be pushed into the same latent space
-                self.concept_prob_generators.append(torch.nn.Linear(2 * emb_size, 1))
-            elif not self.shared_prob_gen:
-                self.concept_prob_generators.append(torch.nn.Linear(2 * emb_size, 1))
+        self.concept_heads = ConceptHeads(
+            list(self.pre_concept_model.modules())[-1].out_features,
+            n_concepts,
+            emb_size,
+            embedding_activation=embedding_activation,
+            shared_prob_gen=shared_prob_gen,
+        )
+        # Checkpoints saved with one Linear per concept are converted to the fused heads as they are loaded
+        self._register_load_state_dict_pre_hook(convert_legacy_concept_heads)
         if c2y_model is None:
             # Else we construct it here directly
             units = [
@@ -166,7 +237,7 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
         self.tau = tau
         self.use_concept_groups = use_concept_groups
 
-        self.fc = nn.Linear(512, self.emb_size)
+        self.fc = nn.Linear(self.trunk.feature_dim, self.emb_size)
         self.pooling = nn.AdaptiveAvgPool2d(1)
 
     def _after_interventions(
@@ -197,21 +268,38 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
         intervention_idxs = intervention_idxs.to(prob.device)
         return prob * (1 - intervention_idxs) + intervention_idxs * c_true, intervention_idxs
 
-    def unlabeled_image_encoder(self, x):
-        # self.pre_concept_model resnet34
-        x = self.pre_concept_model.conv1(x)
-        x = self.pre_concept_model.bn1(x)
-        x = self.pre_concept_model.relu(x)
-        x = self.pre_concept_model.maxpool(x)
-
-        x = self.pre_concept_model.layer1(x)
-        x = self.pre_concept_model.layer2(x)
-        x = self.pre_concept_model.layer3(x)
-        x = self.pre_concept_model.layer4(x)
-        x = x.transpose(1, 3)
+    def unlabeled_image_encoder(self, feature_map):
+        # [batch_size, feature_dim, H, W] trunk feature map -> [batch_size, W, H, emb_size]
+        x = feature_map.transpose(1, 3)
         x = self.fc(x)
         return x
 
+    def concept_heatmap(self, feature_map, c_embedding, top_k=None):
+        """
+        Heatmaps of the concept embeddings over the trunk feature map, all computed by one batched product.
+
+        With `top_k`, only the heatmaps of the `top_k` concepts of every image with the highest pooled heatmap are
+        built, and their [batch_size, top_k] concept indices are returned alongside them.
+        """
+        # image_feature: [batch_size, W, H, D] (D is concept embedding size)
+        # c_embedding: [batch_size, n_concepts, D]
+        # heatmap: [batch_size, n_concepts, W, H] ([batch_size, top_k, W, H] with top_k)
+        image_feature = self.unlabeled_image_encoder(feature_map)
+        if top_k is None:
+            return torch.einsum('bwhd,bnd->bnwh', image_feature, c_embedding)
+        # Pooled heatmaps, without building the full heatmap (see _forward)
+        scores = torch.einsum('bd,bnd->bn', image_feature.mean(dim=(1, 2)), c_embedding)
+        concept_idxs = torch.topk(scores, min(top_k, c_embedding.shape[1]), dim=1).indices
+        c_embedding = torch.gather(c_embedding, 1, concept_idxs.unsqueeze(-1).expand(-1, -1, c_embedding.shape[-1]))
+        return torch.einsum('bwhd,bnd->bnwh', image_feature, c_embedding), concept_idxs
+
+    def _pooled_unlabeled(self, feature_map, c_embedding):
+        # Average pooling commutes with fc (affine) and with the dot product with the concept embeddings, so the
+        # pooled heatmap is the dot product of the embeddings with fc(pooled feature map), without building the
+        # [batch_size, n_concepts, W, H] heatmap
+        image_feature = self.fc(torch.flatten(self.pooling(feature_map), 1))  # [batch_size, D]
+        return self.sigmoid(torch.einsum('bd,bnd->bn', image_feature, c_embedding))
+
     def _forward(
             self,
             x,
@@ -225,25 +313,19 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
             prev_interventions=None,
             output_embeddings=False,
             output_latent=None,
-            output_interventions=None
+            output_interventions=None,
+            output_heatmap=False,
+            heatmap_top_k=None,
+            output_unlabeled=True,
     ):
+        feature_map = None
         if latent is None:
-            pre_c = self.pre_concept_model(x)  # [batch_size, 299, 299] -> [batch_size, resnet_out_features]
-            contexts = []
-            c_sem = []
-
+            # A single backbone pass: [batch_size, 299, 299] -> [batch_size, resnet_out_features] and the
+            # [batch_size, feature_dim, H, W] map the heatmap is built from
+            pre_c, feature_map = self.trunk(x)
             # First predict all the concept probabilities
-            for i, context_gen in enumerate(self.concept_context_generators):
-                if self.shared_prob_gen:
-                    prob_gen = self.concept_prob_generators[0]
-                else:
-                    prob_gen = self.concept_prob_generators[i]
-                context = context_gen(pre_c)  # [batch_size, resnet_out_features] -> [batch_size, 2 * emb_size]
-                prob = prob_gen(context)  # [batch_size, 2 * emb_size] -> [batch_size, 1]
-                contexts.append(torch.unsqueeze(context, dim=1))
-                c_sem.append(self.sigmoid(prob))
-            c_sem = torch.cat(c_sem, axis=-1)  # [batch_size, 1, n_concepts] -> [batch_size, n_concepts]
-            contexts = torch.cat(contexts, axis=1)
+            # contexts: [batch_size, n_concepts, 2 * emb_size], c_sem: [batch_size, n_concepts]
+            contexts, c_sem = self.concept_heads(pre_c)
             latent = contexts, c_sem
         else:
             contexts, c_sem = latent
@@ -300,17 +382,34 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
         )
         c_pred = c_embedding.view((-1, self.emb_size * self.n_concepts))
         y = self.c2y_model(c_pred)
-        image_feature = self.unlabeled_image_encoder(x)
-
-        # image_feature: [batch_size, H, W, D] (D is concept embedding size)
-        # c_embedding: [batch_size, n_concepts, D]
-        # heatmap: [batch_size, n_concepts, H, W]
-        heatmap = []
-        for i in range(len(image_feature)):
-            heatmap.append(torch.matmul(image_feature[i], c_embedding[i].transpose(0, 1)))
-        heatmap = torch.stack(heatmap).permute(0, 3, 1, 2)
-        c_pred_unlabeled = self.pooling(heatmap).squeeze()
-        c_pred_unlabeled = self.sigmoid(c_pred_unlabeled)
+        if output_heatmap and heatmap_top_k is None:
+            if feature_map is None:
+                feature_map = self.trunk.feature_map(x)
+            heatmap = self.concept_heatmap(feature_map, c_embedding)
+            c_pred_unlabeled = self.sigmoid(torch.flatten(self.pooling(heatmap), 1))
+        else:
+            # The unlabeled branch only serves the unlabeled rows (~l) of a batch, c_sem stands in for the other rows
+            # as in a CBM, and for all of them when the branch is not requested
+            c_pred_unlabeled = c_sem
+            unlabeled_idxs = None if l is None else torch.nonzero(~l, as_tuple=True)[0]
+            if output_unlabeled and (unlabeled_idxs is None or len(unlabeled_idxs) > 0):
+                if unlabeled_idxs is None:
+                    if feature_map is None:
+                        feature_map = self.trunk.feature_map(x)
+                    c_pred_unlabeled = self._pooled_unlabeled(feature_map, c_embedding)
+                else:
+                    unlabeled_map = (
+                        self.trunk.feature_map(x[unlabeled_idxs]) if feature_map is None
+                        else feature_map[unlabeled_idxs]
+                    )
+                    c_pred_unlabeled = c_sem.index_put(
+                        (unlabeled_idxs,),
+                        self._pooled_unlabeled(unlabeled_map, c_embedding[unlabeled_idxs]),
+                    )
+            if output_heatmap:
+                if feature_map is None:
+                    feature_map = self.trunk.feature_map(x)
+                heatmap, heatmap_concepts = self.concept_heatmap(feature_map, c_embedding, top_k=heatmap_top_k)
 
         # H = image_feature.size(1)
         # W = image_feature.size(2)
@@ -337,6 +436,10 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
             print(f"output_embedding")
             tail_results.append(contexts[:, :, :self.emb_size])
             tail_results.append(contexts[:, :, self.emb_size:])
+        if output_heatmap:
+            tail_results.append(heatmap)
+            if heatmap_top_k is not None:
+                tail_results.append(heatmap_concepts)
 
         return tuple([c_sem, c_pred, c_pred_unlabeled, y] + tail_results)
 
@@ -349,37 +452,34 @@ class ConceptEmbeddingModel(ConceptBottleneckModel):
             img_name=None,
             output_dir='heatmap',
             concept_set=None,
+            top_k=None,
     ):
-        pre_c = self.pre_concept_model(x)
-        contexts = []
-        c_sem = []
-
-        for i, context_gen in enumerate(self.concept_context_generators):
-            if self.shared_prob_gen:
-                prob_gen = self.concept_prob_generators[0]
-            else:
-                prob_gen = self.concept_prob_generators[i]
-            context = context_gen(pre_c)
-            prob = prob_gen(context)
-            contexts.append(torch.unsqueeze(context, dim=1))
-            c_sem.append(self.sigmoid(prob))
-        c_sem = torch.cat(c_sem, axis=-1)
-        contexts = torch.cat(contexts, axis=1)
+        pre_c, feature_map = self.trunk(x)
+        contexts, c_sem = self.concept_heads(pre_c)
 
         probs = c_sem
         c_embedding = (
                 contexts[:, :, :self.emb_size] * torch.unsqueeze(probs, dim=-1) +
                 contexts[:, :, self.emb_size:] * (1 - torch.unsqueeze(probs, dim=-1))
         )
-        image_feature = self.unlabeled_image_encoder(x)
-
-        heatmap = []
-        for i in range(len(image_feature)):
-            heatmap.append(torch.matmul(image_feature[i], c_embedding[i].transpose(0, 1)))
-        heatmap = torch.stack(heatmap).permute(0, 3, 1, 2)
+        if top_k is None:
+            heatmap = self.concept_heatmap(feature_map, c_embedding)
+            concept_idxs = torch.arange(self.n_concepts).expand(len(x), -1)
+        else:
+            # Only the heatmaps of the top_k concepts of every image
+            heatmap, concept_idxs = self.concept_heatmap(feature_map, c_embedding, top_k=top_k)
+            concept_idxs = concept_idxs.cpu()
 
         for i in range(len(x)):
             # save_dir = f"./{output_dir}/{img_name[i]}"
             save_dir = f"/root/autodl-tmp/heatmap/{img_name[i]}"
 
-            visualize_and_save_heatmaps(x_show[i], c[i], c_sem[i], heatmap[i], save_dir, concept_set)
+            idxs = concept_idxs[i]
+            visualize_and_save_heatmaps(
+                x_show[i],
+                c[i][idxs],
+                c_sem[i][idxs],
+                heatmap[i],
+                save_dir,
+                [str(j) if concept_set is None else concept_set[j] for j in idxs.tolist()],
+            )
@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from data.neighbors import ExactNeighborIndex, IVFNeighborIndex, build_neighbor_index, find_neighbors
+from data.utils import compute_pseudo_concepts
+
+
+def test_ivf_returns_k_valid_neighbors_with_sparse_probes():
+    rng = np.random.default_rng(0)
+    features = rng.normal(size=(3000, 16)).astype(np.float32)
+    labeled_mask = rng.random(3000) < 0.2
+    k = 8
+
+    # Many small lists and a single probe leave some queries with fewer than k probed candidates
+    distances, indices = find_neighbors(
+        features, labeled_mask, k, backend='ivf', recall_sample=0, n_lists=200, n_probe=1
+    )
+    assert indices.shape == (3000, k)
+    assert np.all(indices >= 0)
+    assert np.all(indices < labeled_mask.sum())
+    assert np.all(np.isfinite(distances))
+    assert np.all(np.diff(distances, axis=1) >= -1e-6)
+
+    weights = 1.0 / (distances + 1e-6)
+    weights = weights / np.sum(weights, axis=1, keepdims=True)
+    assert np.all(np.isfinite(weights))
+    concepts = rng.integers(0, 2, size=(3000, 5))
+    pseudo = compute_pseudo_concepts(concepts, np.flatnonzero(labeled_mask), indices, weights)
+    assert np.all(np.isfinite(pseudo))
+
+
+def test_ivf_fallback_matches_exact_search():
+    rng = np.random.default_rng(1)
+    labeled = rng.normal(size=(50, 8)).astype(np.float32)
+    queries = rng.normal(size=(40, 8)).astype(np.float32)
+
+    # With one member per list, every query falls back to the exact search
+    index = IVFNeighborIndex(n_lists=50, n_probe=1).fit(labeled)
+    distances, indices = index.kneighbors(queries, 5)
+    exact_distances, exact_indices = index.exact.kneighbors(queries, 5)
+    assert np.array_equal(indices, exact_indices)
+    assert np.allclose(distances, exact_distances)
+
+
+class _LazyRows(object):
+    """Row provider that only allows reading small slices, like the virtual MNIST-addition samples."""
+
+    def __init__(self, rows, max_rows):
+        self.rows = rows
+        self.max_rows = max_rows
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, idx):
+        rows = self.rows[idx]
+        assert len(rows) <= self.max_rows, "queries were materialised whole"
+        return rows
+
+    def __array__(self, *args, **kwargs):
+        raise AssertionError("queries were materialised whole")
+
+
+@pytest.mark.parametrize('backend', ['exact', 'sklearn', 'ivf', 'hnsw'])
+def test_queries_are_streamed_in_blocks(backend):
+    if backend == 'hnsw':
+        pytest.importorskip('faiss')
+    rng = np.random.default_rng(2)
+    features = rng.normal(size=(500, 8)).astype(np.float32)
+    labeled = features[:100]
+    params = {'memory_budget': 4 * 64 * 8} if backend == 'exact' else {'query_block': 64}
+
+    index = build_neighbor_index(backend, **params).fit(labeled)
+    distances, indices = index.kneighbors(_LazyRows(features, max_rows=64), 3)
+    exact_distances, exact_indices = ExactNeighborIndex().fit(labeled).kneighbors(features, 3)
+    assert indices.shape == (500, 3)
+    if backend in ('exact', 'sklearn'):
+        assert np.array_equal(indices, exact_indices)
+        assert np.allclose(distances, exact_distances, atol=1e-5)
@@ -0,0 +1,50 @@
+import time
+import logging
+import pytorch_lightning as pl
+
+
+class TimeToTargetAccuracy(pl.Callback):
+    """
+    Records the wall-clock time and the epoch at which the validation metric `monitor` first reaches `target`,
+    measured from the start of training. `time_to_target` and `epochs_to_target` stay None if it never does.
+    """
+
+    def __init__(self, target, monitor='val_y_acc'):
+        self.target = target
+        self.monitor = monitor
+        self.start_time = None
+        self.time_to_target = None
+        self.epochs_to_target = None
+
+    def on_train_start(self, trainer, pl_module):
+        self.start_time = time.time()
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if self.start_time is None or self.time_to_target is not None or trainer.sanity_checking:
+            return
+        value = trainer.callback_metrics.get(self.monitor)
+        if value is not None and float(value) >= self.target:
+            self.time_to_target = time.time() - self.start_time
+            self.epochs_to_target = trainer.current_epoch + 1
+            logging.info(f"{self.monitor} reached {self.target} after {self.epochs_to_target} epochs "
+                         f"in {self.time_to_target / 60:.2f} minutes")
+
+
+class EpochTimer(pl.Callback):
+    """
+    Measures the wall-clock time of every training epoch (including the validation run at its end, if any) and logs
+    it as `epoch_time` (in seconds), alongside the accuracy metrics of that epoch.
+    """
+
+    def __init__(self):
+        self.epoch_start = None
+        self.epoch_times = []
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.epoch_start = time.time()
+
+    def on_train_epoch_end(self, trainer, pl_module):
+        epoch_time = time.time() - self.epoch_start
+        self.epoch_times.append(epoch_time)
+        pl_module.log('epoch_time', epoch_time, prog_bar=True)
+        logging.info(f"Epoch {trainer.current_epoch} took {epoch_time:.2f}s")
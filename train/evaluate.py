@@ -112,7 +112,7 @@ def evaluate_representation_metrics(
 
     x_test, y_test, c_test = [], [], []
     for ds_data in test_dl:
-        x, y, c, _, _, _ = ds_data
+        x, y, c = ds_data[:3]
         x_type = x.type()
         y_type = y.type()
         c_type = c.type()
@@ -232,7 +232,7 @@ def evaluate_representation_metrics(
     ):
         x_train, y_train, c_train = [], [], []
         for ds_data in train_dl:
-            x, y, c, _, _, _ = ds_data
+            x, y, c = ds_data[:3]
             x_type = x.type()
             y_type = y.type()
             c_type = c.type()
@@ -11,6 +11,7 @@ from pytorch_lightning.callbacks.early_stopping import EarlyStopping
 
 import cem.train.utils as utils
 from models.construction import construct_model
+from train.callbacks import EpochTimer, TimeToTargetAccuracy
 
 
 def evaluate_cbm(
@@ -141,12 +142,25 @@ def train_end_to_end_model(
         ),
     ]
 
+    # Benchmarks of the data pipeline: wall-clock time of every epoch, and until the validation accuracy reaches
+    # target_accuracy
+    epoch_timer = EpochTimer()
+    trainer_callbacks = [epoch_timer]
+    time_to_target = None
+    if config.get('target_accuracy') is not None:
+        time_to_target = TimeToTargetAccuracy(
+            config['target_accuracy'],
+            monitor=config.get('target_accuracy_monitor', 'val_y_acc'),
+        )
+        trainer_callbacks.append(time_to_target)
+
     trainer = pl.Trainer(
         accelerator=accelerator,
         devices=devices,
         max_epochs=config['max_epochs'],
         check_val_every_n_epoch=config.get("check_val_every_n_epoch", 5),
         # callbacks=callbacks,
+        callbacks=trainer_callbacks,
         logger=logger or False,
         enable_checkpointing=enable_checkpointing,
         gradient_clip_val=gradient_clip_val,
@@ -204,6 +218,11 @@ def train_end_to_end_model(
     )
     eval_results['training_time'] = training_time
     eval_results['num_epochs'] = num_epochs
+    if epoch_timer.epoch_times:
+        eval_results['avg_epoch_time'] = float(np.mean(epoch_timer.epoch_times))
+    if time_to_target is not None:
+        eval_results['time_to_target'] = time_to_target.time_to_target
+        eval_results['epochs_to_target'] = time_to_target.epochs_to_target
     if test_dl is not None:
         logging.info(f'c_acc: {eval_results["test_acc_c"] * 100:.2f}%')
         logging.info(f'y_acc: {eval_results["test_acc_y"] * 100:.2f}%')
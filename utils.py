@@ -14,6 +14,8 @@ import data.cub_loader as cub_data_module
 import data.mnist_loader as mnist_data_module
 import data.celeba_loader as celeba_data_module
 import data.awa2_loader as awa_data_module
+from data.snapshot import DatasetSnapshot, snapshot_cached
+from data.utils import get_label_index, task_class_weights
 from data.synthetic_loader import get_synthetic_data, get_synthetic_num_features, get_synthetic_extractor_arch
 
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
@@ -63,34 +65,24 @@ def update_config_with_dataset(
         n_concepts,
         n_tasks,
         concept_map,
+        snapshot=None,
 ):
     config["n_concepts"] = n_concepts
     config["n_tasks"] = n_tasks
     config["concept_map"] = concept_map
 
-    task_class_weights = None
+    weights = None
+
+    def compute_task_class_weights():
+        # Reduced over the label metadata of the training set, no sample is loaded
+        class_labels, _ = get_label_index(train_dl.dataset)
+        logging.info(f"Computing task class weights in the training dataset with size {len(class_labels)}...")
+        return {'task_class_weights': task_class_weights(class_labels, n_tasks)}
 
     if config.get('use_task_class_weights', False):
-        logging.info(f"Computing task class weights in the training dataset with size {len(train_dl)}...")
-        attribute_count = np.zeros((max(n_tasks, 2),))
-        samples_seen = 0
-        for i, data in enumerate(train_dl):
-            _, y, _, _, _, _ = data
-            if n_tasks > 1:
-                y = torch.nn.functional.one_hot(y, num_classes=n_tasks).cpu().detach().numpy()
-            else:
-                y = torch.cat(
-                    [torch.unsqueeze(1 - y, dim=-1), torch.unsqueeze(y, dim=-1)],
-                    dim=-1).cpu().detach().numpy()
-            attribute_count += np.sum(y, axis=0)
-            samples_seen += y.shape[0]
-        logging.info(f"Class distribution is: {attribute_count / samples_seen}")
-        if n_tasks > 1:
-            task_class_weights = samples_seen / attribute_count - 1
-        else:
-            task_class_weights = np.array([attribute_count[0] / attribute_count[1]])
+        weights = snapshot_cached(snapshot, 'task_class_weights', compute_task_class_weights)['task_class_weights']
 
-    return task_class_weights
+    return weights
 
 
 def generate_dataset_and_update_config(experiment_config, args):
@@ -118,10 +110,26 @@ def generate_dataset_and_update_config(experiment_config, args):
         input_features = get_synthetic_num_features(dataset_config["dataset"])
         experiment_config["c_extractor_arch"] = get_synthetic_extractor_arch(input_features)
 
+    # With a snapshot_dir, prepared splits, labeled masks, pseudo-concepts and class weights are restored from an
+    # on-disk snapshot when the same dataset, config, seed, labeled ratio and data code were already prepared once
+    snapshot_dir = dataset_config.get('snapshot_dir')
+    snapshot = None
+    if snapshot_dir is not None:
+        snapshot = DatasetSnapshot(
+            snapshot_dir,
+            dataset=args.dataset,
+            config=dataset_config,
+            seed=args.seed,
+            labeled_ratio=args.labeled_ratio,
+            rerun=getattr(args, 'rebuild_data', False),
+            extra_code_files=[os.path.abspath(__file__)],
+        )
+
     train_dl, val_dl, test_dl, imbalance, (n_concepts, n_tasks, concept_map) = data_module.generate_data(
         config=dataset_config,
         seed=args.seed,
         labeled_ratio=args.labeled_ratio,
+        snapshot=snapshot,
     )
     logging.info(f"imbalance: {imbalance}")
 
@@ -150,7 +158,10 @@ def generate_dataset_and_update_config(experiment_config, args):
         n_concepts=n_concepts,
         n_tasks=n_tasks,
         concept_map=concept_map,
+        snapshot=snapshot,
     )
+    if snapshot is not None:
+        snapshot.commit()
 
     return (
         train_dl,